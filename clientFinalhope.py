@@ -265,24 +265,807 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
 import socket
+import sys
 import threading
 import struct
 import os
 import hashlib
 import time
+import zlib
+import json
+import bisect
+import math
+from collections import namedtuple, deque
+try:
+    import lzma
+except ImportError:  # Python build thiếu liblzma
+    lzma = None
 
 # Cấu hình chung
 SERVER_IP = "127.0.0.1"  # Dùng localhost khi test
 SERVER_PORT = 12345
-TOTAL_CHUNKS = 100         # Số kết nối/chunk theo yêu cầu đồ án
+TOTAL_CHUNKS = 100         # Số kết nối/chunk theo yêu cầu đồ án (số worker tải song song tối đa)
+MIN_CONCURRENCY = 1        # Số worker tối thiểu khi ConcurrencyController giảm
+INITIAL_CONCURRENCY = 8    # Số worker ban đầu với RTT <= REFERENCE_RTT, RTT lớn hơn thì nhân lên
+REFERENCE_RTT = 0.01
+ADJUST_INTERVAL = 0.5      # Chu kỳ đo goodput và điều chỉnh số worker (giây)
+LOSS_THRESHOLD = 0.02      # Tỉ lệ segment trùng (server phát lại) vượt mức này thì giảm số worker
 CHUNK_TIMEOUT = 2       # Timeout cho việc nhận các segment của 1 chunk
 MAX_RETRIES = 2000
+BUSY_RETRIES = 20          # Số lần gửi lại LIST/DOWNLOAD khi server trả lời BUSY
+WIRE_VERSION = 2           # Định dạng gói muốn dùng (server cũ chỉ hiểu v1)
+CHECKSUM_MODE = "crc32"    # "crc32" hoặc "tag64" (thêm tag blake2b 8 byte cho mỗi gói)
+MANIFEST_TIMEOUT = 30      # Lần đầu server phải hash cả file nên chờ lâu hơn
+LIST_V2_RETRY = 300        # Server có vẻ không hiểu "LIST ver=2": dùng LIST thường trong bấy nhiêu giây rồi thử lại
+MUX_MODE = True            # Nhận mọi part qua cổng SERVER_PORT (server không mở socket riêng cho từng part)
+ACK_EVERY = 16             # Gửi ACK gộp (SACK) sau mỗi ACK_EVERY segment mới...
+ACK_INTERVAL = 0.005       # ...hoặc khi đã chờ quá ACK_INTERVAL giây
+MAX_SACK_RANGES = 32       # Số khoảng SACK tối đa trong một gói ACK
+MAX_RESEND_RANGES = 200    # Số khoảng seq tối đa trong một lệnh RESEND (vừa buffer 4096 byte của server)
+PROBE_SIZES = (1200, 1472, 4000, 8972, 16000, 20000)  # Các kích thước gói thử khi đo path MTU, tăng dần
+PROBE_TIMEOUT = 0.3        # Không có phản hồi PROBE sau khoảng này coi như gói đã bị mất
+FALLBACK_SEGMENT_SIZE = 1200  # Không đo được path MTU (mất hết PROBE) thì xin gói nhỏ, không bao giờ phân mảnh
+VERBOSE = False            # In log cho từng segment nhận/ACK (chậm khi truyền nhanh)
+HAS_RECVMSG = hasattr(socket.socket, "recvmsg")  # recvmsg không có trên Windows
+HAS_UDP_GRO = HAS_RECVMSG and sys.platform.startswith("linux")  # UDP_GRO có từ Linux 5.0
+UDP_GRO = getattr(socket, "UDP_GRO", 104)
+HAS_PWRITE = hasattr(os, "pwrite")  # os.pwrite không có trên Windows
+PARTIAL_SUFFIX = ".part"   # File đang tải dở, đổi tên thành file đích khi đã đủ mọi part
+JOURNAL_SUFFIX = ".journal"  # Nhật ký các khoảng byte đã ghi của file .part, dùng để tải tiếp
+JOURNAL_INTERVAL = 1.0     # Ghi nhật ký xuống đĩa tối đa mỗi khoảng này (giây)
+UNITS_PER_WORKER = 4       # File được chia thành khoảng TOTAL_CHUNKS * UNITS_PER_WORKER work unit...
+MIN_WORK_UNIT = 64 * 1024  # ...nhưng mỗi unit không nhỏ hơn...
+MAX_WORK_UNIT = 1024 * 1024  # ...và không lớn hơn các giá trị này (byte)
+MAX_UNIT_CRASHES = 3       # Số lần worker bị lỗi bất ngờ mà unit còn được đưa lại hàng đợi
+STEAL_AFTER = 1.0          # Chỉ chia đuôi của unit đã tải lâu hơn khoảng này (giây)
+MIN_STEAL_SIZE = 24 * 1024  # Phần còn thiếu phải ít nhất gấp đôi giá trị này mới đáng chia (nhỏ hơn MIN_WORK_UNIT / 2,
+                            # lớn hơn một segment để unit gốc bỏ được ít nhất một segment)
+FEC_MODE = True            # Xin server gửi parity FEC (XOR) khi đo thấy mất gói, False = tắt
+FEC_GROUP = 16             # Số segment dữ liệu trong một nhóm FEC
+FEC_MAX_PARITY = 8         # Số gói parity tối đa cho mỗi nhóm
+FEC_MIN_LOSS = 0.005       # Tỉ lệ mất gói dưới mức này thì không dùng FEC
+FEC_REDUNDANCY = 2.0       # Số gói parity mỗi nhóm ~ số gói mất dự kiến nhân hệ số này
+FEC_LOSS_WINDOW = 1000     # Số segment để ước lượng tỉ lệ mất gói (EWMA)
+# Thuật toán giải nén segment client hỗ trợ, server chọn một (comp=) hoặc gửi nguyên bản
+COMPRESSION_MODES = ("zlib", "lzma") if lzma is not None else ("zlib",)
+MAX_SEGMENT_DATA = 65536   # Giới hạn dữ liệu sau giải nén của một segment
+MULTICAST_MODE = True      # Nhận qua nhóm multicast khi server đề xuất (file lớn, nhiều client cùng tải)
+MULTICAST_INTERFACE = "0.0.0.0"  # Card mạng nhận multicast ("127.0.0.1" để thử trên một máy)
+MULTICAST_JOIN_TIMEOUT = 2.0     # Không có gói multicast nào sau khoảng này thì tải unicast
+MULTICAST_IDLE_LIMIT = 5.0       # Không nhận thêm segment mới lâu như vậy thì tải nốt phần thiếu qua unicast
+NACK_INTERVAL = 0.2        # Chu kỳ gửi NACK các seq còn thiếu trong phiên multicast
+MULTICAST_RCVBUF = 8 * 1024 * 1024  # Server phát theo tốc độ cố định nên cần buffer nhận lớn để không rơi gói
+
+# Định dạng gói v1: part_id, sequence_number, total_segments, checksum MD5 hex
+HEADER_FORMAT = "!III32s"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# Định dạng gói v2: version, flags, header_len, part_id, sequence_number, total_segments, crc32
+HEADER_V2_FORMAT = "!BBHIIII"
+HEADER_V2_SIZE = struct.calcsize(HEADER_V2_FORMAT)
+FLAG_TAG64 = 0x01
+TAG64_SIZE = 8
+FLAG_MUX = 0x02
+TRANSFER_ID_SIZE = 4
+FLAG_PARITY = 0x04         # Gói parity FEC: seq là group * k + j
+FLAG_COMPRESSED = 0x08     # Dữ liệu gói đã nén bằng thuật toán thỏa thuận (comp=)
+# Gói điều khiển gửi về SERVER_PORT ở chế độ mux: magic, type, count, transfer_id
+CTRL_MAGIC = 0xA5
+CTRL_FORMAT = "!BBHI"
+CTRL_ACK = 1
+CTRL_SACK = 2
+CTRL_NACK = 3              # Multicast: transfer_id là session_id, theo sau các khoảng seq còn thiếu
+
+Segment = namedtuple("Segment", "part_id seq total data transfer_id flags")
+
+def split_options(message):
+    """Tách các tùy chọn key=value ở cuối phản hồi, ví dụ "1024 ver=2 sum=crc32" """
+    words = message.split(" ")
+    opts = {}
+    while len(words) > 1 and "=" in words[-1]:
+        key, value = words.pop().split("=", 1)
+        opts[key] = value
+    return " ".join(words), opts
+
+def format_options(opts):
+    return "".join(f" {key}={value}" for key, value in opts.items())
+
+def parse_busy(data):
+    """Trả về số giây phải chờ nếu data là "BUSY retry-after=<ms>", ngược lại None"""
+    if not data.startswith(b"BUSY"):
+        return None
+    _, opts = split_options(data.decode())
+    return int(opts.get("retry-after", 200)) / 1000
+
+def request_reply(sock, message, bufsize):
+    """Gửi yêu cầu và nhận một datagram trả lời; server quá tải (BUSY) thì chờ rồi gửi lại"""
+    for _ in range(BUSY_RETRIES):
+        sock.sendto(message, (SERVER_IP, SERVER_PORT))
+        data, _ = sock.recvfrom(bufsize)
+        delay = parse_busy(data)
+        if delay is None:
+            return data
+        print(f"[CLIENT] Server busy, retrying in {delay:.2f}s")
+        time.sleep(delay)
+    raise ConnectionError("Server busy")
+
+def receive_pages(sock, first=None):
+    """
+    Nhận phản hồi nhiều datagram dạng "PAGE <i> <n>\n<dữ liệu>" và ghép lại;
+    first là datagram đầu tiên nếu đã được đọc trước đó.
+    """
+    pages = {}
+    total = None
+    while total is None or len(pages) < total:
+        if first is not None:
+            data, first = first, None
+        else:
+            data, _ = sock.recvfrom(65535)
+        if data.startswith(b"ERROR:") or data.startswith(b"BUSY"):
+            raise ValueError(data.decode())
+        header, _, body = data.partition(b"\n")
+        _, index, total = header.decode().split()
+        total = int(total)
+        pages[int(index)] = body
+    return b"".join(pages[i] for i in range(total))
+
+def enable_gro(sock):
+    """Cho phép kernel ghép các segment liên tiếp (GRO) thành một lần đọc"""
+    if HAS_UDP_GRO:
+        try:
+            sock.setsockopt(socket.SOL_UDP, UDP_GRO, 1)
+        except OSError:
+            pass
+
+def receive_batch(sock):
+    """
+    Nhận một lần đọc từ socket, trả về (deque các datagram, địa chỉ gửi). Với UDP_GRO,
+    kernel có thể ghép nhiều segment cùng kích thước vào một buffer kèm cmsg gso_size,
+    khi đó buffer được tách lại thành từng segment.
+    """
+    if not HAS_RECVMSG:
+        data, addr = sock.recvfrom(65535)
+        return deque([data]), addr
+    data, ancdata, _, addr = sock.recvmsg(65535, socket.CMSG_SPACE(4))
+    for level, kind, value in ancdata:
+        if level == socket.SOL_UDP and kind == UDP_GRO:
+            size = struct.unpack("=i", value[:4])[0]
+            return deque(data[i:i + size] for i in range(0, len(data), size)), addr
+    return deque([data]), addr
+
+class OutputFile:
+    """
+    File đích được cấp phát trước đủ kích thước; các thread ghi từng segment thẳng vào
+    đúng vị trí (os.pwrite) nên bộ nhớ client không phụ thuộc kích thước file.
+    """
+    def __init__(self, path, size, resume=False):
+        self.path = path
+        self.lock = threading.Lock()  # Chỉ cần khi không có os.pwrite (seek + write)
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        if not resume:
+            flags |= os.O_TRUNC
+        self.fd = os.open(path, flags, 0o644)
+        try:
+            if size > 0:
+                os.posix_fallocate(self.fd, 0, size)
+        except (AttributeError, OSError):
+            # Không có posix_fallocate (Windows, macOS) hoặc filesystem không hỗ trợ
+            os.ftruncate(self.fd, size)
+
+    def write_at(self, offset, data):
+        if HAS_PWRITE:
+            os.pwrite(self.fd, data, offset)
+        else:
+            with self.lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                os.write(self.fd, data)
+
+    def read_at(self, offset, size):
+        if HAS_PWRITE:
+            return os.pread(self.fd, size, offset)
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, size)
+
+    def sync(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        os.close(self.fd)
+
+class DownloadJournal:
+    """
+    Nhật ký nằm cạnh file .part: các khoảng byte [start, end) đã qua kiểm tra checksum
+    và được ghi vào file. Tải lại file thì chỉ cần xin server các khoảng còn thiếu.
+    Nhật ký tính theo byte chứ không theo (part, seq) nên lần tải sau vẫn dùng được
+    dù kích thước segment thỏa thuận với server khác đi.
+    """
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self.ranges = []        # Các khoảng (start, end) đã sắp xếp, không chồng lên nhau
+        self.last_save = time.time()
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path, size):
+        journal = cls(path, size)
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            if data.get("size") == size:
+                for start, end in data["ranges"]:
+                    journal.add(start, end)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        journal.dirty = False
+        return journal
+
+    def add(self, start, end):
+        with self.lock:
+            i = bisect.bisect_right(self.ranges, (start, end))
+            # Gộp với khoảng liền trước nếu chạm nhau, rồi với các khoảng phía sau
+            if i > 0 and self.ranges[i - 1][1] >= start:
+                i -= 1
+                start = self.ranges[i][0]
+                end = max(end, self.ranges[i][1])
+            j = i
+            while j < len(self.ranges) and self.ranges[j][0] <= end:
+                end = max(end, self.ranges[j][1])
+                j += 1
+            self.ranges[i:j] = [(start, end)]
+            self.dirty = True
+
+    def remove(self, start, end):
+        with self.lock:
+            kept = []
+            for s, e in self.ranges:
+                if s < start:
+                    kept.append((s, min(e, start)))
+                if e > end:
+                    kept.append((max(s, end), e))
+            self.ranges = kept
+            self.dirty = True
+
+    def missing(self, offset, size):
+        """Các khoảng (offset, size) còn thiếu trong [offset, offset + size)"""
+        gaps = []
+        position = offset
+        with self.lock:
+            for s, e in self.ranges:
+                if e <= position:
+                    continue
+                if s >= offset + size:
+                    break
+                if s > position:
+                    gaps.append((position, s - position))
+                position = max(position, e)
+        if position < offset + size:
+            gaps.append((position, offset + size - position))
+        return gaps
+
+    def covers(self, offset, size):
+        """True nếu cả khoảng [offset, offset + size) đã được ghi (có thể bởi worker khác)"""
+        with self.lock:
+            i = bisect.bisect_right(self.ranges, (offset, float("inf"))) - 1
+            return i >= 0 and self.ranges[i][1] >= offset + size
+
+    def completed(self):
+        with self.lock:
+            return sum(e - s for s, e in self.ranges)
+
+    def due(self):
+        return self.dirty and time.time() - self.last_save >= JOURNAL_INTERVAL
+
+    def snapshot(self):
+        """
+        Bản chụp các khoảng hiện có để lưu sau khi fsync. Thứ tự phải là chụp -> fsync -> save:
+        khoảng do thread khác thêm vào sau lần chụp không được vào nhật ký khi chưa xuống đĩa.
+        """
+        with self.lock:
+            self.dirty = False
+            self.last_save = time.time()
+            return list(self.ranges)
+
+    def save(self, ranges=None):
+        # Giữ lock khi ghi để hai thread không cùng ghi đè file .tmp
+        with self.lock:
+            if ranges is None:
+                self.dirty = False
+                self.last_save = time.time()
+                ranges = self.ranges
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"size": self.size, "ranges": ranges}, f)
+            os.replace(tmp_path, self.path)
+
+    def delete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class WorkScheduler:
+    """
+    Chia phần còn thiếu của file thành nhiều work unit nhỏ cho một nhóm worker cố định.
+    Worker rảnh lấy unit tiếp theo; khi hết unit mà còn unit đang tải chậm, worker rảnh
+    lấy nửa sau khoảng trống lớn nhất của unit đó (work stealing), nên thời gian tải theo
+    tổng băng thông chứ không theo part chậm nhất. Phần bị lấy được ghi lại theo unit gốc
+    (stolen) để worker của unit đó thu hẹp yêu cầu, không tải trùng phần đuôi.
+    """
+    def __init__(self, journal, file_size):
+        self.lock = threading.Lock()
+        self.journal = journal
+        unit_size = min(MAX_WORK_UNIT, max(MIN_WORK_UNIT, file_size // (TOTAL_CHUNKS * UNITS_PER_WORKER)))
+        self.pending = deque()
+        for offset in range(0, file_size, unit_size):
+            self.pending.extend(journal.missing(offset, min(unit_size, file_size - offset)))
+        self.active = {}        # unit_id -> (offset, size, thời điểm bắt đầu)
+        self.stolen = {}        # unit_id -> các khoảng byte (start, end) đã giao cho worker khác
+        self.failed = []        # Các unit (offset, size) đã hết lượt thử
+        self.crashes = 0        # Số lần worker gặp lỗi bất ngờ giữa chừng
+        self.next_id = 0
+
+    def take(self):
+        """Trả về (unit_id, offset, size) cho worker rảnh, None nếu không còn việc"""
+        with self.lock:
+            if self.pending:
+                offset, size = self.pending.popleft()
+            else:
+                stolen = self.steal()
+                if stolen is None:
+                    return None
+                offset, size = stolen
+            unit_id = self.next_id
+            self.next_id += 1
+            self.active[unit_id] = (offset, size, time.time())
+            return unit_id, offset, size
+
+    def steal(self):
+        # Tìm khoảng trống lớn nhất trong các unit đã tải quá STEAL_AFTER giây
+        best = None
+        victim = None
+        now = time.time()
+        for unit_id, (offset, size, started) in self.active.items():
+            if now - started < STEAL_AFTER:
+                continue
+            for gap in self.remaining(unit_id, offset, size):
+                if best is None or gap[1] > best[1]:
+                    best = gap
+                    victim = unit_id
+        if best is None or best[1] < 2 * MIN_STEAL_SIZE:
+            return None
+        # Unit gốc gửi theo thứ tự seq nên nửa sau là phần nó sẽ nhận muộn nhất
+        half = best[1] // 2
+        start, end = best[0] + half, best[0] + best[1]
+        self.stolen.setdefault(victim, []).append((start, end))
+        print(f"[CLIENT] Stealing {end - start} bytes at offset {start} from unit {victim}")
+        return start, end - start
+
+    def remaining(self, unit_id, offset, size):
+        """Các khoảng (offset, size) unit còn thiếu, trừ phần đã bị worker khác lấy"""
+        gaps = self.journal.missing(offset, size)
+        for s, e in self.stolen.get(unit_id, ()):
+            kept = []
+            for start, length in gaps:
+                end = start + length
+                if s > start:
+                    kept.append((start, min(end, s) - start))
+                if e < end:
+                    kept.append((max(start, e), end - max(start, e)))
+            gaps = [gap for gap in kept if gap[1] > 0]
+        return gaps
+
+    def stolen_from(self, unit_id):
+        """Các khoảng byte (start, end) của unit đã giao cho worker khác"""
+        with self.lock:
+            return list(self.stolen.get(unit_id, ()))
+
+    def crash(self, unit_id):
+        """
+        Worker gặp lỗi bất ngờ khi tải unit: trả phần còn thiếu về hàng đợi cho worker khác,
+        quá MAX_UNIT_CRASHES lần thì coi là hỏng để không lặp lỗi mãi.
+        """
+        with self.lock:
+            offset, size, _ = self.active.pop(unit_id)
+            gaps = self.remaining(unit_id, offset, size)
+            self.stolen.pop(unit_id, None)
+            self.crashes += 1
+            if self.crashes > MAX_UNIT_CRASHES:
+                self.failed.extend(gaps)
+            else:
+                self.pending.extend(gaps)
+
+    def finish(self, unit_id, ok):
+        with self.lock:
+            offset, size, _ = self.active.pop(unit_id)
+            self.stolen.pop(unit_id, None)
+            if not ok:
+                self.failed.append((offset, size))
+
+class ConcurrencyController:
+    """
+    Chọn số worker tải song song lúc chạy thay vì cố định TOTAL_CHUNKS: bắt đầu theo số
+    work unit và RTT đo được, sau đó mỗi ADJUST_INTERVAL so goodput với lần đo trước
+    (leo đồi): goodput còn tăng thì thêm worker; có mất gói (segment trùng, part phải thử
+    lại) hoặc goodput giảm thì bớt worker.
+    """
+    def __init__(self, units, rtt):
+        scale = max(1.0, rtt / REFERENCE_RTT)
+        self.limit = max(MIN_CONCURRENCY, min(units, TOTAL_CHUNKS, round(INITIAL_CONCURRENCY * scale)))
+        self.lock = threading.Lock()
+        self.running = 0
+        self.last_goodput = 0.0
+        # Bộ đếm gần đúng, các worker tăng không cần lock
+        self.segments = 0
+        self.duplicates = 0
+        self.retries = 0
+        print(f"[CLIENT] Concurrency: starting with {self.limit} workers (rtt {rtt * 1000:.1f}ms, {units} units)")
+
+    def adjust(self, goodput):
+        total = self.segments + self.duplicates
+        loss = self.duplicates / total if total else 0.0
+        retries = self.retries
+        self.segments = self.duplicates = self.retries = 0
+        old = self.limit
+        if retries or loss > LOSS_THRESHOLD or goodput < self.last_goodput * 0.9:
+            self.limit = max(MIN_CONCURRENCY, self.limit - max(1, self.limit // 4))
+        elif goodput > self.last_goodput * 1.05:
+            self.limit = min(TOTAL_CHUNKS, self.limit + max(1, self.limit // 2))
+        self.last_goodput = goodput
+        if self.limit != old:
+            print(f"[CLIENT] Concurrency: {old} -> {self.limit} workers "
+                  f"(goodput {goodput / 1e6:.2f} MB/s, loss {loss:.1%}, retries {retries})")
+
+    def start_worker(self):
+        with self.lock:
+            self.running += 1
+
+    def should_stop(self):
+        """Worker gọi sau mỗi unit: True (và tự trừ) nếu đang có nhiều worker hơn giới hạn"""
+        with self.lock:
+            if self.running > self.limit:
+                self.running -= 1
+                return True
+            return False
+
+    def stop_worker(self):
+        with self.lock:
+            self.running -= 1
+
+# Kích thước segment đo được cho mỗi server (None nếu server không hỗ trợ PROBE)
+path_mtu_cache = {}
+
+def probe_segment_size(server_addr):
+    """
+    Đo kích thước gói lớn nhất đi tới client mà không bị phân mảnh/mất: gửi "PROBE <size>"
+    với các kích thước tăng dần trong PROBE_SIZES, server trả về datagram đúng size byte
+    (cờ DF). Dừng ở kích thước đầu tiên bị mất hoặc bị báo TOOBIG. Kết quả được nhớ theo server.
+    """
+    if server_addr in path_mtu_cache:
+        return path_mtu_cache[server_addr]
+    best = None
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(PROBE_TIMEOUT)
+    try:
+        for size in PROBE_SIZES:
+            sock.sendto(f"PROBE {size}".encode(), server_addr)
+            try:
+                while True:
+                    data, _ = sock.recvfrom(65535)
+                    # Bỏ qua phản hồi trễ của các lần thử trước
+                    words = data[:64].split()
+                    if len(words) >= 3 and words[0] == b"PROBE" and words[1] == str(size).encode():
+                        break
+            except socket.timeout:
+                break
+            if words[2] != b"OK" or len(data) != size:
+                break
+            best = size
+    finally:
+        sock.close()
+    print(f"[CLIENT] Path MTU probe to {server_addr}: segment size {best}")
+    path_mtu_cache[server_addr] = best
+    return best
+
+def verify_file(path, manifest):
+    """
+    So sánh file đã tải với manifest của server.
+    Trả về danh sách block bị sai (rỗng nếu file đúng).
+    """
+    block_size = manifest["block_size"]
+    whole = hashlib.sha256()
+    bad_blocks = []
+    with open(path, "rb") as f:
+        for index, expected in enumerate(manifest["blocks"]):
+            block = f.read(block_size)
+            whole.update(block)
+            if hashlib.blake2b(block, digest_size=8).hexdigest() != expected:
+                bad_blocks.append(index)
+        extra = f.read(1)
+    if extra or os.path.getsize(path) != manifest["size"]:
+        bad_blocks.append(len(manifest["blocks"]))
+    if not bad_blocks and whole.hexdigest() != manifest["sha256"]:
+        bad_blocks = list(range(len(manifest["blocks"])))
+    return bad_blocks
+
+def decompress_segment(algorithm, data):
+    """Giải nén dữ liệu một segment, lỗi nào cũng thành ValueError; max_length chặn gói giải nén ra quá lớn"""
+    try:
+        if algorithm == "lzma" and lzma is not None:
+            return lzma.LZMADecompressor().decompress(data, MAX_SEGMENT_DATA)
+        if algorithm == "zlib":
+            return zlib.decompressobj().decompress(data, MAX_SEGMENT_DATA)
+    except Exception as e:  # zlib.error, lzma.LZMAError, EOFError
+        raise ValueError(str(e))
+    raise ValueError(f"unsupported compression {algorithm!r}")
+
+def parse_segment(packet, version):
+    """
+    Giải mã một gói dữ liệu theo định dạng đã thỏa thuận.
+    Trả về Segment hoặc None nếu gói hỏng.
+    """
+    if version >= 2:
+        if len(packet) < HEADER_V2_SIZE:
+            return None
+        _, flags, header_len, part_id, seq, tot_seg, crc = struct.unpack_from(HEADER_V2_FORMAT, packet)
+        data_segment = packet[header_len:]
+        if zlib.crc32(data_segment) != crc:
+            return None
+        pos = HEADER_V2_SIZE
+        transfer_id = 0
+        if flags & FLAG_MUX:
+            (transfer_id,) = struct.unpack_from("!I", packet, pos)
+            pos += TRANSFER_ID_SIZE
+        if flags & FLAG_TAG64:
+            tag = packet[pos:pos + TAG64_SIZE]
+            if hashlib.blake2b(data_segment, digest_size=TAG64_SIZE).digest() != tag:
+                return None
+        return Segment(part_id, seq, tot_seg, data_segment, transfer_id, flags)
+    if len(packet) < HEADER_SIZE:
+        return None
+    part_id, seq, tot_seg, chksum_bytes = struct.unpack(HEADER_FORMAT, packet[:HEADER_SIZE])
+    data_segment = packet[HEADER_SIZE:]
+    if hashlib.md5(data_segment).hexdigest() != chksum_bytes.decode():
+        return None
+    return Segment(part_id, seq, tot_seg, data_segment, 0, 0)
+
+class FecTuner:
+    """
+    Ước lượng tỉ lệ mất gói (EWMA trên khoảng FEC_LOSS_WINDOW segment) từ các lỗ hổng seq
+    mà các part thấy, rồi chọn tham số fec=n:k cho yêu cầu CHUNK tiếp theo: mạng càng mất
+    nhiều gói thì càng nhiều parity, mạng sạch thì tắt FEC để không tốn băng thông.
+    """
+    def __init__(self):
+        self.loss = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, expected, lost):
+        if expected <= 0:
+            return
+        weight = min(1.0, expected / FEC_LOSS_WINDOW)
+        with self.lock:
+            self.loss += weight * (lost / expected - self.loss)
+
+    def params(self):
+        if self.loss < FEC_MIN_LOSS:
+            return None
+        k = min(FEC_MAX_PARITY, FEC_GROUP // 2, math.ceil(FEC_GROUP * self.loss * FEC_REDUNDANCY))
+        return FEC_GROUP, k
+
+class FecDecoder:
+    """
+    Dựng lại segment mất của một part từ gói parity. Nhóm g gồm n segment từ seq g*n,
+    parity j của nhóm là XOR các segment g*n + j, g*n + j + k, ... Lớp nào chỉ thiếu đúng
+    một segment thì segment đó bằng parity XOR các segment còn lại (đọc lại từ file đích).
+    """
+    def __init__(self, n, k, size, total, received, read_segment):
+        self.n = n
+        self.k = k
+        self.size = size
+        self.total = total
+        self.received = received
+        self.read_segment = read_segment  # (position, length) -> bytes đã ghi
+        self.parities = {}                # (group, j) -> dữ liệu parity chưa dùng tới
+
+    def members(self, group, j):
+        return range(group * self.n + j, min((group + 1) * self.n, self.total), self.k)
+
+    def add_parity(self, seq, payload):
+        """Nhận parity; trả về danh sách (seq, data) dựng lại được"""
+        group, j = divmod(seq, self.k)
+        if group * self.n >= self.total:
+            return []
+        self.parities[(group, j)] = payload
+        return self.solve(group, j)
+
+    def add_data(self, seq):
+        """Segment seq vừa tới: lớp của nó có parity đang chờ thì thử giải lại"""
+        group, index = divmod(seq, self.n)
+        key = (group, index % self.k)
+        return self.solve(*key) if key in self.parities else []
+
+    def solve(self, group, j):
+        parity = self.parities[(group, j)]
+        missing = [seq for seq in self.members(group, j) if seq not in self.received]
+        if len(missing) != 1:
+            if not missing:
+                del self.parities[(group, j)]
+            return []
+        del self.parities[(group, j)]
+        data_size = len(parity)
+        value = int.from_bytes(parity, "big")
+        for seq in self.members(group, j):
+            if seq != missing[0]:
+                data = self.read_segment(*self.place(seq, data_size))
+                value ^= int.from_bytes(data.ljust(data_size, b"\0"), "big")
+        position, length = self.place(missing[0], data_size)
+        return [(missing[0], value.to_bytes(data_size, "big")[:length])]
+
+    def place(self, seq, data_size):
+        """(vị trí trong part, độ dài) của segment seq; mọi segment trừ segment cuối đều đầy"""
+        if seq == self.total - 1:
+            length = self.size - seq * data_size
+            return self.size - length, length
+        return seq * data_size, data_size
+
+class SackTracker:
+    """
+    Theo dõi các segment đã nhận của một part để gửi ACK gộp: cumulative ACK
+    (mọi seq < cum đã nhận) cộng danh sách khoảng [start, end) đã nhận phía trên cum.
+    """
+    def __init__(self):
+        self.cum = 0
+        self.above = set()     # Các seq đã nhận nhưng > cum (nhận không theo thứ tự)
+        self.pending = 0       # Số segment mới chưa được báo cho server
+        self.last_sent = time.time()
+
+    def add(self, seq):
+        if seq < self.cum or seq in self.above:
+            return False
+        self.above.add(seq)
+        while self.cum in self.above:
+            self.above.remove(self.cum)
+            self.cum += 1
+        self.pending += 1
+        return True
+
+    def due(self):
+        return self.pending >= ACK_EVERY or (self.pending > 0 and time.time() - self.last_sent >= ACK_INTERVAL)
+
+    def build(self, transfer_id):
+        ranges = []
+        for seq in sorted(self.above):
+            if ranges and ranges[-1][1] == seq:
+                ranges[-1][1] = seq + 1
+            else:
+                ranges.append([seq, seq + 1])
+        ranges = ranges[:MAX_SACK_RANGES]
+        self.pending = 0
+        self.last_sent = time.time()
+        return (struct.pack(CTRL_FORMAT, CTRL_MAGIC, CTRL_SACK, len(ranges), transfer_id)
+                + struct.pack("!I", self.cum)
+                + b"".join(struct.pack("!II", start, end) for start, end in ranges))
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def missing_ranges(received, total):
+    """
+    Các khoảng seq còn thiếu dạng "start-end,start-end" (không tính end) cho lệnh RESEND.
+    Quá MAX_RESEND_RANGES khoảng thì khoảng cuối kéo dài tới hết part.
+    """
+    return ",".join(f"{start}-{end}" for start, end in missing_range_list(received, total))
+
+def missing_range_list(received, total):
+    """Các khoảng [start, end) seq còn thiếu, tối đa MAX_RESEND_RANGES khoảng"""
+    ranges = []
+    start = None
+    for seq in range(total):
+        if seq not in received:
+            if start is None:
+                start = seq
+        elif start is not None:
+            ranges.append([start, seq])
+            start = None
+    if start is not None:
+        ranges.append([start, total])
+    if len(ranges) > MAX_RESEND_RANGES:
+        ranges = ranges[:MAX_RESEND_RANGES]
+        ranges[-1][1] = total
+    return ranges
+
+def receive_multicast(group, port, session_id, file_size, output, journal, on_progress):
+    """
+    Nhận file từ phiên multicast của server: vào nhóm group:port, ghi mọi segment của
+    session_id vào output và journal, định kỳ gửi NACK (unicast tới SERVER_PORT) cho
+    các seq còn thiếu. Trả về True nếu nhận đủ; False nếu không nhận được gì (mạng không
+    chuyển multicast) hoặc phiên dừng giữa chừng, khi đó phần thiếu được tải unicast.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # Nhiều client trên cùng máy
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MULTICAST_RCVBUF)
+    sock.bind(("", port))
+    membership = socket.inet_aton(group) + socket.inet_aton(MULTICAST_INTERFACE)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    sock.settimeout(NACK_INTERVAL)
+    enable_gro(sock)
+    received = set()
+    total = None
+    data_size = None
+    last_progress = last_nack = time.time()
+    try:
+        while total is None or len(received) < total:
+            try:
+                batch, _ = receive_batch(sock)
+            except socket.timeout:
+                batch = ()
+            for packet in batch:
+                parsed = parse_segment(packet, 2)
+                if parsed is None or parsed.part_id != session_id or parsed.flags & FLAG_PARITY:
+                    continue
+                seq, data_segment = parsed.seq, parsed.data
+                if total is None:
+                    total = parsed.total
+                if seq >= total or seq in received:
+                    continue
+                if seq == total - 1:
+                    position = file_size - len(data_segment)
+                else:
+                    position = seq * len(data_segment)
+                    if data_size is None:
+                        # Biết kích thước segment: các seq đã có từ lần tải trước coi như đã nhận
+                        data_size = len(data_segment)
+                        received.update(s for s in range(total - 1)
+                                        if journal.covers(s * data_size, data_size))
+                output.write_at(position, data_segment)
+                journal.add(position, position + len(data_segment))
+                if journal.due():
+                    ranges = journal.snapshot()
+                    output.sync()
+                    journal.save(ranges)
+                received.add(seq)
+                last_progress = time.time()
+                on_progress(len(received) * 100 // total)
+            now = time.time()
+            if now - last_progress > (MULTICAST_JOIN_TIMEOUT if total is None else MULTICAST_IDLE_LIMIT):
+                print(f"[CLIENT] Multicast session {session_id}: no data for {now - last_progress:.1f}s, giving up")
+                return False
+            if total is not None and now - last_nack >= NACK_INTERVAL:
+                ranges = missing_range_list(received, total)
+                nack = struct.pack(CTRL_FORMAT, CTRL_MAGIC, CTRL_NACK, len(ranges), session_id)
+                nack += b"".join(struct.pack("!II", start, end) for start, end in ranges)
+                sock.sendto(nack, (SERVER_IP, SERVER_PORT))
+                last_nack = now
+        print(f"[CLIENT] Multicast session {session_id}: received all {total} segments")
+        return True
+    finally:
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_DROP_MEMBERSHIP, membership)
+        except OSError:
+            pass
+        sock.close()
+
+def make_ack(segment, seq=None):
+    """
+    ACK cho một segment: gói điều khiển theo transfer_id ở chế độ mux, ngược lại (part_id, seq).
+    seq mặc định là seq của segment; segment dựng lại từ parity thì truyền seq của nó vào.
+    """
+    if seq is None:
+        seq = segment.seq
+    if segment.flags & FLAG_MUX:
+        return struct.pack(CTRL_FORMAT, CTRL_MAGIC, CTRL_ACK, 1, segment.transfer_id) + struct.pack("!I", seq)
+    return struct.pack("!II", segment.part_id, seq)
 
 class DownloadClient:
     def __init__(self, root):
         self.root = root
         self.root.title("UDP File Downloader")
         self.root.geometry("600x500")
+        self.file_names = []       # Tên file theo thứ tự trong listbox (listbox hiển thị kèm kích thước)
+        self.list_version = None   # Version danh sách server đã gửi, để LIST chỉ nhận lại khi có thay đổi
+        self.plain_list_until = 0  # Tới thời điểm này chỉ gửi LIST thường (server có vẻ là bản cũ)
 
         ttk.Label(root, text="Available Files:", font=("Arial", 12)).pack(pady=5)
         self.file_listbox = tk.Listbox(root, height=10, selectmode=tk.SINGLE)
@@ -307,23 +1090,55 @@ class DownloadClient:
     def handle_ctrl_c(self, event):
         self.root.quit()
 
-    def update_file_list(self, file_list):
+    def update_file_list(self, files):
+        self.file_names = [f["name"] for f in files]
         self.file_listbox.delete(0, tk.END)
-        for f in file_list:
-            if f.strip():
-                self.file_listbox.insert(tk.END, f.strip())
+        for f in files:
+            if f.get("size") is None:
+                self.file_listbox.insert(tk.END, f["name"])
+            else:
+                self.file_listbox.insert(tk.END, f"{f['name']}  ({format_size(f['size'])})")
+
+    def fetch_file_list(self):
+        """
+        Lấy danh sách file: [{"name", "size", "mtime", "sha256"}], hoặc None nếu không đổi
+        so với lần trước. Server cũ không hiểu "LIST ver=2" thì hỏi lại LIST thường.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(5)
+        try:
+            if time.time() < self.plain_list_until:
+                data = request_reply(sock, b"LIST", 65535)
+            else:
+                try:
+                    data = request_reply(sock, f"LIST ver=2 since={self.list_version}".encode(), 65535)
+                except socket.timeout:
+                    # Chỉ coi là server cũ khi LIST thường được trả lời ngay sau đó, và cũng
+                    # chỉ tạm thời: một datagram bị mất không được làm mất JSON/since= mãi mãi
+                    data = request_reply(sock, b"LIST", 65535)
+                    if not data.startswith(b"ERROR:"):
+                        self.plain_list_until = time.time() + LIST_V2_RETRY
+            if data.startswith(b"UNCHANGED"):
+                return None
+            if data.startswith(b"ERROR:"):
+                raise ValueError(data.decode())
+            if data.startswith(b"PAGE"):
+                catalog = json.loads(receive_pages(sock, data))
+                self.list_version = catalog["version"]
+                files = catalog["files"]
+            else:
+                files = [{"name": name.strip()} for name in data.decode().split("\n") if name.strip()]
+        finally:
+            sock.close()
+        print(f"[CLIENT] Received file list: {[f['name'] for f in files]}")
+        return files
 
     def get_file_list(self):
         def worker():
             try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock.settimeout(5)
-                sock.sendto(b"LIST", (SERVER_IP, SERVER_PORT))
-                data, _ = sock.recvfrom(4096)
-                file_list = data.decode().split("\n")
-                self.root.after(0, lambda: self.update_file_list(file_list))
-                print(f"[CLIENT] Received file list: {file_list}")
-                sock.close()
+                files = self.fetch_file_list()
+                if files is not None:
+                    self.root.after(0, lambda: self.update_file_list(files))
             except Exception as e:
                 err = str(e)
                 self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to get file list: {err}"))
@@ -333,54 +1148,118 @@ class DownloadClient:
         return hashlib.md5(data).hexdigest()
 
     def start_download(self):
-        selected_file = self.file_listbox.get(tk.ACTIVE)
-        if not selected_file:
+        if not self.file_names:
             messagebox.showwarning("Warning", "Please select a file to download!")
             return
+        selected_file = self.file_names[self.file_listbox.index(tk.ACTIVE)]
         threading.Thread(target=self.download_file, args=(selected_file,), daemon=True).start()
 
-    def download_file(self, filename):
-        # Yêu cầu kích thước file
+    def request_file_size(self, filename, opts):
+        """Gửi DOWNLOAD (kèm tùy chọn định dạng gói) và trả về phản hồi của server"""
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.settimeout(5)
-        sock.sendto(f"DOWNLOAD {filename}".encode(), (SERVER_IP, SERVER_PORT))
         try:
-            data, _ = sock.recvfrom(1024)
+            data = request_reply(sock, f"DOWNLOAD {filename}{format_options(opts)}".encode(), 1024)
+        finally:
+            sock.close()
+        return data.decode()
+
+    def request_manifest(self, filename):
+        """Lấy manifest (kích thước, sha256, hash từng block) của file; None nếu không lấy được"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(MANIFEST_TIMEOUT)
+        try:
+            sock.sendto(f"MANIFEST {filename}".encode(), (SERVER_IP, SERVER_PORT))
+            return json.loads(receive_pages(sock))
+        except (socket.timeout, ValueError) as e:
+            print(f"[CLIENT] Manifest unavailable for '{filename}': {e}")
+            return None
+        finally:
+            sock.close()
+
+    def download_file(self, filename):
+        # Yêu cầu kích thước file, đề xuất định dạng gói v2
+        wanted = {"ver": str(WIRE_VERSION), "sum": CHECKSUM_MODE} if WIRE_VERSION >= 2 else {}
+        if wanted and MUX_MODE:
+            wanted["mux"] = "1"
+        if wanted:
+            # Server chỉ gửi segment vừa path MTU đo được, tránh phân mảnh IP
+            # Không đo được thì vẫn gửi seg= nhỏ: bỏ trống thì server dùng gói 20000 byte bị
+            # phân mảnh; server cũ không hiểu seg= thì đã tự lùi về DOWNLOAD thường
+            segment_size = probe_segment_size((SERVER_IP, SERVER_PORT))
+            wanted["seg"] = str(segment_size or FALLBACK_SEGMENT_SIZE)
+            if FEC_MODE:
+                wanted["fec"] = "1"
+            wanted["comp"] = ",".join(COMPRESSION_MODES)
+            if MULTICAST_MODE:
+                wanted["mcast"] = "1"
+        try:
+            started = time.time()
+            response = self.request_file_size(filename, wanted)
+            if response.startswith("ERROR:") and wanted:
+                # Server cũ coi cả "tên file + tùy chọn" là tên file: hỏi lại kiểu v1
+                started = time.time()
+                response = self.request_file_size(filename, {})
+            rtt = time.time() - started
         except socket.timeout:
             messagebox.showerror("Error", "Timeout while requesting file size!")
-            sock.close()
             return
-        sock.close()
+        except ConnectionError:
+            messagebox.showerror("Error", "Server is busy, please try again later!")
+            return
 
-        response = data.decode()
         if response.startswith("ERROR:"):
             messagebox.showerror("Error", response)
             return
 
+        response, wire_opts = split_options(response)
+        version = int(wire_opts.get("ver", 1))
+        has_manifest = wire_opts.pop("manifest", None) == "1"
+        has_resend = wire_opts.pop("resend", None) == "1"
+        has_fec = wire_opts.pop("fec", None) == "1"
+        multicast = wire_opts.pop("mcast", None)
         try:
             file_size = int(response)
         except ValueError:
             messagebox.showerror("Error", f"Invalid file size received: {response}")
             return
 
-        print(f"[CLIENT] File '{filename}' size: {file_size}")
-        # Tính toán offset và kích thước cho từng chunk
-        part_size = file_size // TOTAL_CHUNKS
-        sizes = [part_size] * TOTAL_CHUNKS
-        remainder = file_size - part_size * TOTAL_CHUNKS
-        sizes[-1] += remainder
-        offsets = [i * part_size for i in range(TOTAL_CHUNKS)]
+        # Lấy manifest song song với việc tải để kiểm tra toàn bộ file ở cuối
+        manifest_result = [None]
+        def fetch_manifest():
+            manifest_result[0] = self.request_manifest(filename)
+        manifest_thread = threading.Thread(target=fetch_manifest, daemon=True)
+        if has_manifest:
+            manifest_thread.start()
+
+        print(f"[CLIENT] File '{filename}' size: {file_size} (wire v{version})")
+
+        # Còn file .part và nhật ký của lần tải trước: chỉ tải các khoảng còn thiếu
+        partial_path = filename + PARTIAL_SUFFIX
+        resume = os.path.exists(partial_path)
+        journal = DownloadJournal.load(partial_path + JOURNAL_SUFFIX, file_size) if resume else \
+            DownloadJournal(partial_path + JOURNAL_SUFFIX, file_size)
+        if journal.ranges:
+            print(f"[CLIENT] Resuming '{filename}': {journal.completed()}/{file_size} bytes already downloaded")
+        output = OutputFile(partial_path, file_size, resume=bool(journal.ranges))
 
-        # Mở cửa sổ để hiển thị tiến độ tải cho từng chunk
+        # Mở cửa sổ để hiển thị tiến độ tải của từng worker (label được tạo khi thêm worker)
         progress_window = tk.Toplevel(self.root)
         progress_window.title(f"Downloading {filename}")
         chunk_labels = []
-        for i in range(TOTAL_CHUNKS):
-            lbl = ttk.Label(progress_window, text=f"Part {i+1}: 0%")
-            lbl.pack(pady=2)
-            chunk_labels.append(lbl)
 
-        results = [None] * TOTAL_CHUNKS
+        if multicast and not journal.covers(0, file_size):
+            # Server phát file này qua multicast: nhận chung với các client khác, phần nào
+            # vẫn thiếu (multicast bị chặn, phiên dừng) sẽ được các worker tải unicast bên dưới
+            group, port, session_id = multicast.rsplit(":", 2)
+            print(f"[CLIENT] Joining multicast session {session_id} on {group}:{port}")
+            mcast_label = ttk.Label(progress_window, text="Multicast: 0%")
+            mcast_label.pack(pady=2)
+            receive_multicast(group, int(port), int(session_id), file_size, output, journal,
+                              lambda p: self.root.after(0, lambda: mcast_label.config(text=f"Multicast: {p}%")))
+        scheduler = WorkScheduler(journal, file_size)
+        concurrency = ConcurrencyController(len(scheduler.pending), rtt)
+        fec_tuner = FecTuner()
 
         # def download_part(part_id, offset, size, progress_label):
         #     attempts = 0
@@ -455,96 +1334,311 @@ class DownloadClient:
         #         return None
         def download_part(part_id, offset, size, progress_label):
             attempts = 0
-            segments = {}          # Tích lũy các segment đã nhận được
+            received = set()       # Các seq đã ghi vào file
             expected_segments = None
-            HEADER_FORMAT = "!III32s"  # part_id, sequence_number, total_segments, checksum
-            HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+            use_sack = wire_opts.get("sack") == "1"
+            tracker = SackTracker()
+            sender_addr = None
+            transfer_id = 0
+            recovered_count = 0    # Số segment dựng lại từ parity FEC
+            skipped = set()        # Các seq nằm trọn trong phần đã bị worker khác lấy (work stealing)
+            stolen_seen = 0        # Số khoảng bị lấy đã xử lý
+            segment_bytes = None   # Độ dài dữ liệu của một segment đầy, để đổi khoảng byte ra seq
+
+            def store(seq, data_segment):
+                nonlocal segment_bytes
+                # Mọi segment trừ segment cuối đều đầy nên vị trí suy ra từ seq và độ dài
+                if seq == expected_segments - 1:
+                    position = size - len(data_segment)
+                else:
+                    position = seq * len(data_segment)
+                    segment_bytes = len(data_segment)
+                output.write_at(offset + position, data_segment)
+                journal.add(offset + position, offset + position + len(data_segment))
+                if journal.due():
+                    # Dữ liệu phải xuống đĩa trước khi nhật ký ghi nhận nó: chụp nhật ký
+                    # trước khi fsync để không ghi nhận khoảng thread khác vừa thêm
+                    ranges = journal.snapshot()
+                    output.sync()
+                    journal.save(ranges)
+                received.add(seq)
+                skipped.discard(seq)
+                if VERBOSE:
+                    print(f"[CLIENT] Part {part_id}: Received seq {seq} (total {len(received)}/{expected_segments})")
+                progress = int((len(received) / expected_segments) * 100)
+                self.root.after(0, lambda p=progress, lbl=progress_label: lbl.config(text=f"Part {part_id+1}: {p}%"))
+
+            def part_done():
+                # Đủ segment của chính part này (trừ phần đuôi đã bị worker khác lấy),
+                # hoặc worker khác đã tải xong cả phần đuôi bị chia
+                return ((expected_segments is not None and len(received) + len(skipped) == expected_segments)
+                        or journal.covers(offset, size))
+
+            def narrow():
+                """
+                Worker khác vừa lấy phần đuôi của unit: bỏ các seq nằm trọn trong phần đó.
+                True nếu có seq mới bị bỏ, khi đó gửi RESEND để server không gửi trùng phần đuôi.
+                """
+                nonlocal stolen_seen
+                if len(scheduler.stolen.get(part_id, ())) == stolen_seen or segment_bytes is None:
+                    return False
+                stolen = scheduler.stolen_from(part_id)
+                before = len(skipped)
+                for start, end in stolen[stolen_seen:]:
+                    seq = -(-(start - offset) // segment_bytes)
+                    while seq < expected_segments and min((seq + 1) * segment_bytes, size) <= end - offset:
+                        if seq not in received:
+                            skipped.add(seq)
+                        seq += 1
+                stolen_seen = len(stolen)
+                return len(skipped) > before
 
+            # Giữ cùng một socket qua các lần thử để server nhận ra yêu cầu mới thay cho transfer cũ
+            sock_part = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            enable_gro(sock_part)
             while attempts < MAX_RETRIES:
                 print(f"[CLIENT] Part {part_id}: Attempt {attempts+1}")
-                sock_part = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
                 sock_part.settimeout(CHUNK_TIMEOUT)
-                sock_part.sendto(f"CHUNK {filename} {offset} {size} {part_id}".encode(), (SERVER_IP, SERVER_PORT))
+                if has_resend and expected_segments is not None and (received or skipped):
+                    # Thử lại: chỉ xin server gửi các seq còn thiếu thay vì cả part
+                    request = (f"RESEND {filename} {offset} {size} {part_id} "
+                               f"{missing_ranges(received | skipped, expected_segments)}")
+                else:
+                    request = f"CHUNK {filename} {offset} {size} {part_id}"
+                request_opts = wire_opts
+                fec = fec_tuner.params() if has_fec and request.startswith("CHUNK") else None
+                if fec:
+                    request_opts = dict(wire_opts, fec=f"{fec[0]}:{fec[1]}")
+                sock_part.sendto(f"{request}{format_options(request_opts)}".encode(), (SERVER_IP, SERVER_PORT))
+                decoder = None
+                # Lỗ hổng seq trong lượt gửi đầu tiên dùng để ước lượng tỉ lệ mất gói cho FEC
+                measure_loss = request.startswith("CHUNK")
+                highest = -1
+                gaps = 0
                 start_time = time.time()
+                sender_addr = None
+                transfer_id = 0
+                busy_delay = None
+                narrowed = False   # Lượt này dừng vì vừa bỏ phần đuôi bị lấy
+                batch = deque()  # Các segment của lần đọc trước (GRO) chưa xử lý
                 while True:
-                    try:
-                        packet, sender_addr = sock_part.recvfrom(65535)
-                    except socket.timeout:
-                        print(f"[CLIENT] Part {part_id}: Timeout waiting for packet")
-                        break  # Thoát vòng lặp inner nếu timeout
+                    if not batch:
+                        # Còn segment chưa báo thì chỉ chờ ACK_INTERVAL rồi gửi SACK
+                        flush_pending = use_sack and tracker.pending > 0 and sender_addr is not None
+                        sock_part.settimeout(ACK_INTERVAL if flush_pending else CHUNK_TIMEOUT)
+                        try:
+                            batch, sender_addr = receive_batch(sock_part)
+                        except socket.timeout:
+                            if flush_pending:
+                                sock_part.sendto(tracker.build(transfer_id), sender_addr)
+                                continue
+                            print(f"[CLIENT] Part {part_id}: Timeout waiting for packet")
+                            break  # Thoát vòng lặp inner nếu timeout
+                    packet = batch.popleft()
                     if packet.startswith(b"ERROR:"):
                         print(f"[CLIENT] Part {part_id}: Received error packet")
                         continue
-                    if len(packet) < HEADER_SIZE:
-                        print(f"[CLIENT] Part {part_id}: Received packet too small")
-                        continue
+                    busy_delay = parse_busy(packet)
+                    if busy_delay is not None:
+                        break
                     try:
-                        header = packet[:HEADER_SIZE]
-                        part_id_recv, seq, tot_seg, chksum_bytes = struct.unpack(HEADER_FORMAT, header)
-                    except struct.error:
+                        parsed = parse_segment(packet, version)
+                    except (struct.error, UnicodeDecodeError):
                         print(f"[CLIENT] Part {part_id}: Struct unpack error")
                         continue
+                    if parsed is None:
+                        print(f"[CLIENT] Part {part_id}: Corrupted or too small packet")
+                        continue
+                    part_id_recv, seq, tot_seg, data_segment = parsed[:4]
                     if part_id_recv != part_id:
                         print(f"[CLIENT] Part {part_id}: Received packet for different part {part_id_recv}")
                         continue
+                    if parsed.flags & FLAG_COMPRESSED:
+                        try:
+                            data_segment = decompress_segment(wire_opts.get("comp"), data_segment)
+                        except ValueError:
+                            print(f"[CLIENT] Part {part_id}: Cannot decompress seq {seq}")
+                            continue
                     if expected_segments is None:
                         expected_segments = tot_seg
                         print(f"[CLIENT] Part {part_id}: Expected segments = {expected_segments}")
-                    data_segment = packet[HEADER_SIZE:]
-                    computed_checksum = hashlib.md5(data_segment).hexdigest()
-                    expected_checksum = chksum_bytes.decode()
-                    if computed_checksum != expected_checksum:
-                        print(f"[CLIENT] Part {part_id}: Checksum mismatch for seq {seq}")
-                        continue
-                    if seq not in segments:
-                        segments[seq] = data_segment
-                        print(f"[CLIENT] Part {part_id}: Received seq {seq} (total {len(segments)}/{expected_segments})")
-                        # Gửi ACK về sender_addr (địa chỉ của socket phụ server)
-                        ack_packet = struct.pack("!II", part_id, seq)
-                        sock_part.sendto(ack_packet, sender_addr)
-                        print(f"[CLIENT] Part {part_id}: Sent ACK for seq {seq} to {sender_addr}")
-                        progress = int((len(segments) / expected_segments) * 100)
-                        self.root.after(0, lambda p=progress, lbl=progress_label: lbl.config(text=f"Part {part_id+1}: {p}%"))
-                    if expected_segments is not None and len(segments) == expected_segments:
+                    if fec and decoder is None:
+                        decoder = FecDecoder(fec[0], fec[1], size, expected_segments, received,
+                                             lambda position, length: output.read_at(offset + position, length))
+                    is_parity = bool(parsed.flags & FLAG_PARITY)
+                    if is_parity:
+                        recovered = decoder.add_parity(seq, data_segment) if decoder else []
+                        if not recovered:
+                            continue
+                        is_new = True
+                    else:
+                        if seq >= expected_segments:
+                            # Ghi ra ngoài phạm vi part sẽ đè lên part khác
+                            print(f"[CLIENT] Part {part_id}: Invalid seq {seq}")
+                            continue
+                        is_new = seq not in received
+                        recovered = []
+                        if not is_new:
+                            concurrency.duplicates += 1
+                        else:
+                            concurrency.segments += 1
+                            if measure_loss and seq > highest + 1:
+                                gaps += sum(1 for s in range(highest + 1, seq) if s not in received)
+                            highest = max(highest, seq)
+                            store(seq, data_segment)
+                            if decoder:
+                                recovered = decoder.add_data(seq)
+                    for recovered_seq, recovered_data in recovered:
+                        # Segment mất được dựng lại từ parity, không phải chờ server phát lại
+                        if VERBOSE:
+                            print(f"[CLIENT] Part {part_id}: Recovered seq {recovered_seq} from parity")
+                        store(recovered_seq, recovered_data)
+                        recovered_count += 1
+                    # Gửi ACK về sender_addr (socket phụ của server, hoặc SERVER_PORT ở chế độ mux).
+                    # Segment trùng nghĩa là ACK trước đã bị mất nên cũng phải ACK lại.
+                    if use_sack:
+                        transfer_id = parsed.transfer_id
+                        if not is_parity:
+                            tracker.add(seq)
+                        for recovered_seq, _ in recovered:
+                            tracker.add(recovered_seq)
+                        if not is_new or tracker.due() or len(received) == expected_segments:
+                            sock_part.sendto(tracker.build(transfer_id), sender_addr)
+                            if VERBOSE:
+                                print(f"[CLIENT] Part {part_id}: Sent SACK cum {tracker.cum} to {sender_addr}")
+                    else:
+                        # seq của gói parity không thuộc dải seq dữ liệu: chỉ ACK các seq dữ liệu
+                        # vừa nhận hoặc vừa dựng lại, nếu không server sẽ phát lại chúng
+                        acked = [] if is_parity else [seq]
+                        acked.extend(recovered_seq for recovered_seq, _ in recovered)
+                        for ack_seq in acked:
+                            sock_part.sendto(make_ack(parsed, ack_seq), sender_addr)
+                            if VERBOSE:
+                                print(f"[CLIENT] Part {part_id}: Sent ACK for seq {ack_seq} to {sender_addr}")
+                    if part_done():
+                        break
+                    if has_resend and narrow():
+                        narrowed = True
                         break
                     if time.time() - start_time > CHUNK_TIMEOUT:
                         print(f"[CLIENT] Part {part_id}: CHUNK_TIMEOUT reached after {time.time()-start_time:.2f}s")
                         break
-                sock_part.close()
-                if expected_segments is not None and len(segments) == expected_segments:
+                if measure_loss:
+                    fec_tuner.record(highest + 1, gaps)
+                if part_done():
                     break
+                if narrowed:
+                    # Không phải lỗi: gửi RESEND mới chỉ gồm phần còn lại, server dừng transfer cũ
+                    print(f"[CLIENT] Part {part_id}: Tail taken by another worker, "
+                          f"{expected_segments - len(received) - len(skipped)} segments left")
+                    continue
+                concurrency.retries += 1
+                if busy_delay is not None:
+                    # Server từ chối vì quá tải: chờ theo retry-after, không tính là một lần thử hỏng
+                    print(f"[CLIENT] Part {part_id}: Server busy, retrying in {busy_delay:.2f}s")
+                    time.sleep(busy_delay)
+                    continue
                 attempts += 1
                 print(f"[CLIENT] Part {part_id}: Retrying, attempt {attempts}")
                 time.sleep(0.5)  # Thêm delay giữa các lần retry
-            if expected_segments is not None and len(segments) == expected_segments:
+            if part_done() and use_sack and sender_addr is not None and len(received) < expected_segments:
+                # Phần đuôi do worker khác tải: báo server đã có đủ để transfer kết thúc ngay
+                for seq in range(expected_segments):
+                    tracker.add(seq)
+                sock_part.sendto(tracker.build(transfer_id), sender_addr)
+            sock_part.close()
+            if part_done():
                 self.root.after(0, lambda lbl=progress_label: lbl.config(text=f"Part {part_id+1}: 100%"))
-                chunk_data = b"".join(segments[i] for i in sorted(segments))
-                print(f"[CLIENT] Part {part_id}: Completed with {len(segments)}/{expected_segments} segments")
-                return chunk_data
+                print(f"[CLIENT] Part {part_id}: Completed with {len(received)}/{expected_segments} own segments"
+                      f" ({recovered_count} recovered by FEC)")
+                return True
             else:
                 self.root.after(0, lambda lbl=progress_label: lbl.config(text=f"Part {part_id+1}: Failed"))
                 print(f"[CLIENT] Part {part_id}: Failed after {attempts} attempts")
                 return None
-        def thread_download(i):
-            data_part = download_part(i, offsets[i], sizes[i], chunk_labels[i])
-            results[i] = data_part
+        free_slots = []             # Label của các worker đã dừng, dùng lại cho worker mới
+        worker_exited = threading.Event()
+
+        def thread_download(slot):
+            # Worker lấy unit từ scheduler cho tới khi hết việc hoặc bị bớt đi; mỗi unit là một yêu cầu CHUNK
+            try:
+                while True:
+                    unit = scheduler.take()
+                    if unit is None:
+                        concurrency.stop_worker()
+                        break
+                    unit_id, offset, size = unit
+                    try:
+                        ok = download_part(unit_id, offset, size, chunk_labels[slot])
+                    except Exception as e:
+                        print(f"[CLIENT] Part {unit_id}: Worker error {e!r}, requeueing")
+                        scheduler.crash(unit_id)
+                        concurrency.stop_worker()
+                        break
+                    scheduler.finish(unit_id, ok)
+                    if concurrency.should_stop():
+                        break
+            finally:
+                self.root.after(0, lambda lbl=chunk_labels[slot]: lbl.config(text=f"Worker {slot+1}: idle"))
+                free_slots.append(slot)
+                worker_exited.set()
 
+        # Vòng điều khiển: thêm worker tới giới hạn hiện tại, đo goodput rồi điều chỉnh giới hạn
         threads = []
-        for i in range(TOTAL_CHUNKS):
-            t = threading.Thread(target=thread_download, args=(i,))
-            threads.append(t)
-            t.start()
-        for t in threads:
-            t.join()
-
-        if any(r is None for r in results):
-            missing = [i for i, r in enumerate(results) if r is None]
-            messagebox.showerror("Error", f"Download failed! Missing parts: {missing}")
+        last_bytes, last_time = journal.completed(), time.time()
+        while True:
+            threads = [t for t in threads if t.is_alive()]
+            if not threads and not scheduler.pending:
+                break
+            while len(threads) < concurrency.limit and scheduler.pending:
+                if free_slots:
+                    slot = free_slots.pop()
+                else:
+                    slot = len(chunk_labels)
+                    lbl = ttk.Label(progress_window, text=f"Worker {slot+1}: idle")
+                    lbl.pack(pady=2)
+                    chunk_labels.append(lbl)
+                concurrency.start_worker()
+                t = threading.Thread(target=thread_download, args=(slot,))
+                threads.append(t)
+                t.start()
+            worker_exited.wait(ADJUST_INTERVAL)
+            worker_exited.clear()
+            now = time.time()
+            if now - last_time >= ADJUST_INTERVAL:
+                done_bytes = journal.completed()
+                concurrency.adjust((done_bytes - last_bytes) / (now - last_time))
+                last_bytes, last_time = done_bytes, now
+        output.sync()
+        output.close()
+
+        # Chỉ báo thành công khi mọi unit đã xong và nhật ký phủ cả file
+        for offset, size, _ in scheduler.active.values():
+            scheduler.failed.append((offset, size))
+        if not scheduler.failed and file_size > 0 and not journal.covers(0, file_size):
+            scheduler.failed.extend(journal.missing(0, file_size))
+        if scheduler.failed:
+            journal.save()
+            messagebox.showerror("Error", f"Download failed! Missing ranges (offset, size): {scheduler.failed}. "
+                                          "Download again to resume.")
             return
 
-        with open(filename, "wb") as outfile:
-            for i in range(TOTAL_CHUNKS):
-                outfile.write(results[i])
+        if has_manifest:
+            manifest_thread.join()
+        manifest = manifest_result[0]
+        if manifest is not None:
+            bad_blocks = verify_file(partial_path, manifest)
+            if bad_blocks:
+                # Bỏ các block sai khỏi nhật ký để lần tải sau chỉ lấy lại các block đó
+                block_size = manifest["block_size"]
+                for index in bad_blocks:
+                    journal.remove(index * block_size, (index + 1) * block_size)
+                journal.save()
+                messagebox.showerror("Error", f"Integrity check failed! Corrupted blocks: {bad_blocks}")
+                return
+            print(f"[CLIENT] File '{filename}' matches server sha256 {manifest['sha256']}")
+        os.replace(partial_path, filename)
+        journal.delete()
         messagebox.showinfo("Download Complete", f"File {filename} downloaded successfully!")
 
     def compute_checksum(self, data):
@@ -150,167 +150,2109 @@
 # if __name__ == "__main__":
 #     main()
 import socket
+import sys
 import os
 import struct
 import hashlib
 import threading
+import mmap
+import zlib
+import json
+import asyncio
+import argparse
+import queue
+import time
+import signal
+import ctypes
+import errno
+from collections import OrderedDict, deque
+try:
+    import lzma
+except ImportError:  # Python build thiếu liblzma
+    lzma = None
 
 # Cấu hình Server
 SERVER_IP = "0.0.0.0"
 SERVER_PORT = 12345
-TIMEOUT = 2  # Timeout chờ ACK cho từng gói con
+TIMEOUT = 2  # RTO ban đầu (giây) khi chưa đo được RTT của transfer
+MIN_RTO = 0.05              # Cận dưới RTO (RFC 6298 dùng 1s, quá lớn cho mạng LAN)
+MAX_RTO = 60                # Cận trên RTO khi nhân đôi liên tiếp
+TRANSFER_IDLE_LIMIT = 60    # Bỏ transfer nếu quá số giây này không có ACK mới (client đã thoát)
+MAX_STALLED_RTOS = 5        # Bỏ transfer sau chừng này lần RTO liên tiếp không có ACK mới
+CONGESTION_CONTROL = "aimd" # Thuật toán chống nghẽn: "aimd", "delay" hoặc "none"
+INITIAL_CWND = 10           # Cửa sổ chống nghẽn ban đầu (số segment) cho mỗi client
+MIN_CWND = 2
+MAX_CWND = 20000
+CC_POLL_INTERVAL = 0.005    # Transfer bị cwnd chung chặn thì kiểm tra lại sau khoảng này
+DUP_THRESH = 3              # Segment bị coi là mất khi đã có DUP_THRESH segment sau nó được SACK
+PACING_RATE = 0             # Giới hạn tổng tốc độ gửi của server (byte/giây), 0 = không giới hạn
+PART_PACING_RATE = 0        # Giới hạn tốc độ gửi của mỗi part (byte/giây), 0 = không giới hạn
+PACING_GAIN = 1.25          # Tốc độ theo cwnd/SRTT được nhân hệ số này để cwnd vẫn còn chỗ tăng
+WORKER_THREADS = 128        # Số thread cố định gửi CHUNK/RESEND (engine thread), mỗi transfer giữ một thread;
+                            # mọi thread đều bận thì trả lời BUSY ngay, không xếp hàng
+MANIFEST_THREADS = 2        # Số thread riêng tính/gửi MANIFEST (hash file lớn) để không chiếm thread gửi chunk
+MAX_PENDING_MANIFESTS = 32  # Số MANIFEST tối đa chờ thread rảnh, vượt quá thì trả lời BUSY
+MAX_ACTIVE_TRANSFERS = 10000  # Số part gửi cùng lúc tối đa ở engine asyncio (không tốn thread cho mỗi part)
+BUSY_RETRY_AFTER = 200      # Thời gian (ms) client nên chờ trước khi gửi lại yêu cầu bị từ chối
+COMPRESSION = "zlib"        # Thuật toán nén segment khi client hỗ trợ: "zlib", "lzma" hoặc "none"
+COMPRESSION_LEVEL = 1       # Mức nén 1 (nhanh nhất) - 9 (nhỏ nhất); nén chạy trên thread gửi nên ưu tiên nhanh
+COMPRESS_MIN_RATIO = 0.9    # Nén mà còn lớn hơn tỉ lệ này so với bản gốc thì gửi nguyên bản
+COMPRESS_SAMPLES = 16       # Số mẫu lấy rải đều trong file để đoán file có nén được không
+COMPRESS_SAMPLE_SIZE = 16 * 1024
+PACKET_CACHE_BYTES = 64 * 1024 * 1024  # Dung lượng cache segment dựng sẵn (checksum, bản nén, parity) dùng chung
+PACKET_CACHE_ENTRY_COST = 200          # Số byte ước tính cho mỗi entry ngoài payload (khóa, checksum)
+MULTICAST_ENABLED = False   # Phát file lớn qua multicast cho mọi client cùng tải (bật bằng --multicast)
+MULTICAST_GROUP = "239.255.42.99"
+MULTICAST_PORT = 12346
+MULTICAST_INTERFACE = "0.0.0.0"  # Địa chỉ card mạng phát multicast ("127.0.0.1" để thử trên một máy)
+MULTICAST_TTL = 1           # Chỉ trong mạng LAN
+MULTICAST_RATE = 10 * 1024 * 1024  # Tốc độ phát (byte/giây): multicast không có ACK nên không có cwnd
+MULTICAST_MIN_SIZE = 1024 * 1024   # File nhỏ hơn thì vẫn tải unicast
+MULTICAST_JOIN_DELAY = 0.2  # Chờ client tham gia nhóm trước khi phát lượt đầu
+MULTICAST_LINGER = 2.0      # Phát xong mà không có NACK/client mới trong khoảng này thì kết thúc phiên
+MULTICAST_SEGMENT_SIZE = 1472  # Kích thước gói cố định của phiên (vừa MTU Ethernet của LAN), không theo client đầu tiên
 FILE_LIST = "files.txt"
+CATALOG_SCAN_DIR = False      # True: LIST liệt kê mọi file trong thư mục làm việc thay vì đọc FILE_LIST
+CATALOG_CHECK_INTERVAL = 1.0  # Kiểm tra nguồn danh sách và metadata file nhiều nhất một lần mỗi khoảng này (giây)
+WORKER_PROCESSES = 1        # Số process cùng nghe SERVER_PORT bằng SO_REUSEPORT, 1 = một process
+WORKER_INDEX = 0            # Thứ tự process này trong nhóm, nằm ở byte cao của transfer_id
+HAS_REUSEPORT = hasattr(socket, "SO_REUSEPORT") and hasattr(os, "fork")  # Không có trên Windows
+SO_ATTACH_REUSEPORT_CBPF = getattr(socket, "SO_ATTACH_REUSEPORT_CBPF", 51)  # Linux 4.5+
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")  # sendmsg (scatter/gather) không có trên Windows
+HAS_UDP_GSO = HAS_SENDMSG and sys.platform.startswith("linux")  # UDP_SEGMENT có từ Linux 4.18
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+MAX_GSO_SEGMENTS = 64      # Số segment tối đa kernel nhận trong một lần gửi GSO
+MAX_GSO_BYTES = 65507      # Tổng kích thước tối đa của một lần gửi GSO (giới hạn datagram IPv4)
+VERBOSE = False            # In log cho từng segment gửi/phát lại (chậm khi truyền nhanh)
+MAX_OPEN_FILES = 64  # Số file tối đa giữ mmap sẵn trong cache dùng chung
+MAX_PATH_MTU_CLIENTS = 4096  # Số IP client tối đa được nhớ kích thước segment (seg=)
+SAFE_UDP_SIZE = 20000  # Kích thước tối đa gói UDP an toàn (điều chỉnh theo môi trường)
+PACING_BURST = 4 * SAFE_UDP_SIZE  # Số byte tối đa được gửi dồn liền nhau
+MIN_SEGMENT_SIZE = 512  # Kích thước segment nhỏ nhất khi thỏa thuận theo path MTU (seg=)
+HAS_PMTUDISC = hasattr(socket, "IP_MTU_DISCOVER")  # Đặt cờ DF cho gói PROBE, chỉ có trên Linux
+
+# Định dạng gói v1 (client cũ): part_id, sequence_number, total_segments, checksum MD5 hex
+HEADER_FORMAT = "!III32s"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# Định dạng gói v2: version, flags, header_len, part_id, sequence_number, total_segments, crc32
+HEADER_V2_FORMAT = "!BBHIIII"
+HEADER_V2_SIZE = struct.calcsize(HEADER_V2_FORMAT)
+WIRE_VERSION = 2          # Phiên bản định dạng gói cao nhất server hỗ trợ
+FLAG_TAG64 = 0x01         # Sau header cố định có thêm tag 8 byte (blake2b) của dữ liệu
+TAG64_SIZE = 8
+FLAG_MUX = 0x02           # Sau header cố định có transfer_id 4 byte (chế độ một socket)
+TRANSFER_ID_SIZE = 4
+FLAG_PARITY = 0x04        # Gói parity FEC: sequence_number là group * k + j, dữ liệu là XOR các segment
+MAX_FEC_GROUP = 64        # Số segment dữ liệu tối đa trong một nhóm FEC (fec=n:k)
+FLAG_COMPRESSED = 0x08    # Dữ liệu của gói đã được nén bằng thuật toán thỏa thuận (comp=)
+CHECKSUM_MODES = ("crc32", "tag64")
+# Gói điều khiển nhị phân client gửi về cổng SERVER_PORT ở chế độ mux:
+# magic, type, count, transfer_id (byte đầu 0xA5 để phân biệt với lệnh dạng text)
+CTRL_MAGIC = 0xA5
+CTRL_FORMAT = "!BBHI"
+CTRL_SIZE = struct.calcsize(CTRL_FORMAT)
+CTRL_ACK = 1              # Theo sau là sequence_number (4 byte)
+CTRL_SACK = 2             # Theo sau là cumulative ACK (4 byte) và count khoảng SACK [start, end) (mỗi khoảng 8 byte)
+CTRL_NACK = 3             # Multicast: transfer_id là session_id, theo sau count khoảng seq [start, end) client còn thiếu
+CTRL_FORWARD = 4          # Giữa các worker: transfer_id = WORKER_INDEX đích << 24, theo sau IP (4 byte),
+                          # cổng (2 byte) của client và yêu cầu DOWNLOAD gốc
+MANIFEST_BLOCK_SIZE = 1024 * 1024   # Kích thước block khi tính hash từng phần của file
+MANIFEST_SUFFIX = ".manifest.json"  # File index nằm cạnh file gốc
+MAX_REPLY_SIZE = 60000              # Dữ liệu tối đa của một datagram trả lời (LIST, MANIFEST)
 
 def compute_checksum(data):
     return hashlib.md5(data).hexdigest()  # Trả về chuỗi 32 ký tự hex
 
-def send_file_list(sock, client_addr):
-    """Gửi danh sách file có sẵn cho client"""
-    if not os.path.exists(FILE_LIST):
+def compute_tag64(data):
+    return hashlib.blake2b(data, digest_size=TAG64_SIZE).digest()
+
+def split_options(message):
+    """
+    Tách các tùy chọn dạng key=value ở cuối yêu cầu, ví dụ
+    "DOWNLOAD 1GB.zip ver=2 sum=crc32" -> ("DOWNLOAD 1GB.zip", {"ver": "2", "sum": "crc32"}).
+    Client cũ không gửi tùy chọn nên vẫn được phục vụ theo định dạng v1.
+    """
+    words = message.split(" ")
+    opts = {}
+    while len(words) > 1 and "=" in words[-1]:
+        key, value = words.pop().split("=", 1)
+        opts[key] = value
+    return " ".join(words), opts
+
+def parse_fec(value):
+    """Tách "n:k" (k gói parity cho mỗi nhóm n segment) thành (n, k); None nếu không hợp lệ"""
+    try:
+        n, k = (int(x) for x in value.split(":"))
+    except (AttributeError, ValueError):
+        return None
+    if 2 <= n <= MAX_FEC_GROUP and 1 <= k <= n // 2:
+        return n, k
+    return None
+
+def xor_parity(segments, size):
+    """XOR các segment (segment ngắn hơn được coi như đệm 0 ở cuối) thành một khối size byte"""
+    value = 0
+    for segment in segments:
+        value ^= int.from_bytes(bytes(segment).ljust(size, b"\0"), "big")
+    return value.to_bytes(size, "big")
+
+# Kích thước segment (seg=) đã thỏa thuận gần nhất với mỗi IP client, dùng lại khi client không gửi seg=.
+# LRU tối đa MAX_PATH_MTU_CLIENTS IP để server chạy lâu không giữ mọi client từng kết nối
+path_mtu_cache = OrderedDict()
+path_mtu_lock = threading.Lock()
+
+def negotiate_options(opts, client_ip=None):
+    """Chọn định dạng gói dùng cho client theo những gì client đề xuất"""
+    accepted = {}
+    try:
+        version = min(int(opts.get("ver", 1)), WIRE_VERSION)
+    except ValueError:
+        version = 1
+    if version >= 2:
+        accepted["ver"] = str(version)
+        accepted["sum"] = opts.get("sum") if opts.get("sum") in CHECKSUM_MODES else "crc32"
+        accepted["manifest"] = "1"  # Server hỗ trợ lệnh MANIFEST <filename>
+        # Client gửi ACK gộp (cumulative + SACK) thay vì một ACK cho mỗi segment
+        accepted["sack"] = "1"
+        # Khi thử lại, client gửi RESEND kèm các khoảng seq còn thiếu thay vì CHUNK cả part
+        accepted["resend"] = "1"
+        if opts.get("mux") == "1":
+            # Mọi segment và ACK đi qua cổng SERVER_PORT, phân biệt bằng transfer_id
+            accepted["mux"] = "1"
+        # FEC: DOWNLOAD hỏi fec=1 để biết server hỗ trợ, mỗi CHUNK gửi fec=n:k muốn dùng
+        fec = parse_fec(opts.get("fec"))
+        if fec:
+            accepted["fec"] = f"{fec[0]}:{fec[1]}"
+        elif opts.get("fec") == "1":
+            accepted["fec"] = "1"
+        # Nén segment: client liệt kê các thuật toán giải nén được (comp=zlib,lzma)
+        if COMPRESSION in COMPRESSORS and COMPRESSION in opts.get("comp", "").split(","):
+            accepted["comp"] = COMPRESSION
+        # Kích thước gói (header + dữ liệu) vừa path MTU mà client đã đo bằng PROBE
+        try:
+            segment_size = int(opts["seg"])
+        except (KeyError, ValueError):
+            segment_size = path_mtu_cache.get(client_ip)
+        if segment_size:
+            segment_size = max(MIN_SEGMENT_SIZE, min(segment_size, SAFE_UDP_SIZE))
+            if client_ip is not None:
+                with path_mtu_lock:
+                    path_mtu_cache[client_ip] = segment_size
+                    path_mtu_cache.move_to_end(client_ip)
+                    while len(path_mtu_cache) > MAX_PATH_MTU_CLIENTS:
+                        path_mtu_cache.popitem(last=False)
+            accepted["seg"] = str(segment_size)
+    return accepted
+
+def format_options(opts):
+    return "".join(f" {key}={value}" for key, value in opts.items())
+
+def send_file_list(sock, client_addr, opts=None):
+    """
+    Gửi danh sách file từ file_catalog (không đọc đĩa cho mỗi yêu cầu). LIST kiểu cũ nhận
+    mỗi dòng một tên file; "LIST ver=2 since=<version>" nhận JSON có kích thước, mtime,
+    sha256 qua nhiều datagram (send_paged), hoặc "UNCHANGED <version>" nếu danh sách
+    không đổi kể từ version client đang có.
+    """
+    snapshot = file_catalog.snapshot()
+    if snapshot is None:
         sock.sendto(b"ERROR: No file list found.", client_addr)
         return
-    with open(FILE_LIST, "r") as f:
-        files = f.read()
-    print(f"[SERVER] Sending file list to {client_addr}")
-    sock.sendto(files.encode(), client_addr)
+    version, plain, payload = snapshot
+    opts = opts or {}
+    if "ver" not in opts:
+        print(f"[SERVER] Sending file list to {client_addr}")
+        sock.sendto(plain, client_addr)
+    elif opts.get("since") == version:
+        sock.sendto(f"UNCHANGED {version}".encode(), client_addr)
+    else:
+        print(f"[SERVER] Sending file catalog (version {version}) to {client_addr}")
+        send_paged(sock, client_addr, payload)
 
-def send_file_size(sock, client_addr, filename):
-    """Gửi kích thước file cho client"""
+def send_file_size(sock, client_addr, filename, opts=None, forwarded=False):
+    """Gửi kích thước file cho client, kèm các tùy chọn định dạng gói đã thỏa thuận"""
     if not os.path.exists(filename):
         sock.sendto(b"ERROR: File not found.", client_addr)
         return
     filesize = os.path.getsize(filename)
+    accepted = negotiate_options(opts or {}, client_addr[0])
+    # Client đo được path MTU nhỏ hơn gói của phiên thì tải unicast
+    if (MULTICAST_ENABLED and (opts or {}).get("mcast") == "1" and accepted.get("ver") == "2"
+            and filesize >= MULTICAST_MIN_SIZE
+            and int(accepted.get("seg", SAFE_UDP_SIZE)) >= MULTICAST_SEGMENT_SIZE):
+        owner = multicast_owner(filename)
+        if owner != WORKER_INDEX and not forwarded:
+            # Chỉ một worker phát mỗi file, nếu không egress sẽ tăng theo số worker
+            forward_request(sock, client_addr, owner, f"DOWNLOAD {filename}{format_options(opts)}")
+            return
+        # Client vào phiên multicast đang phát file này (hoặc mở phiên mới)
+        session = multicast_sessions.join(filename)
+        accepted["mcast"] = f"{MULTICAST_GROUP}:{MULTICAST_PORT}:{session.session_id}"
     print(f"[SERVER] Sending file size {filesize} for '{filename}' to {client_addr}")
-    sock.sendto(f"{filesize}".encode(), client_addr)
+    sock.sendto(f"{filesize}{format_options(accepted)}".encode(), client_addr)
+
+def multicast_owner(filename):
+    """Worker phát multicast của file: mọi process tính ra cùng một chỉ số"""
+    return zlib.crc32(filename.encode()) % WORKER_PROCESSES
 
-def send_chunk_part_sliding_window(sock, client_addr, filename, offset, size, part_id):
+def forward_address():
+    """Địa chỉ các worker gửi CTRL_FORWARD cho nhau (cổng SERVER_PORT trên chính máy này)"""
+    return ("127.0.0.1" if SERVER_IP == "0.0.0.0" else SERVER_IP, SERVER_PORT)
+
+def forward_request(sock, client_addr, worker, message):
     """
-    Đọc file từ offset với size byte, sau đó chia thành nhiều gói UDP nhỏ
-    và gửi theo cơ chế sliding window.
-    
-    Header của mỗi gói được định nghĩa theo định dạng:
+    Chuyển yêu cầu của client cho worker khác: bộ lọc reuseport đưa gói điều khiển tới
+    socket theo byte cao của transfer_id, worker đó trả lời thẳng cho client.
+    """
+    header = struct.pack(CTRL_FORMAT, CTRL_MAGIC, CTRL_FORWARD, 0, worker << 24)
+    address = socket.inet_aton(client_addr[0]) + struct.pack("!H", client_addr[1])
+    sock.sendto(header + address + message.encode(), forward_address())
+
+def handle_forward(sock, packet, sender):
+    """Trả lời DOWNLOAD do worker khác chuyển tới; bỏ gói không đến từ chính server"""
+    if sender != forward_address() or len(packet) < CTRL_SIZE + 6:
+        return
+    client_addr = (socket.inet_ntoa(packet[CTRL_SIZE:CTRL_SIZE + 4]),
+                   struct.unpack_from("!H", packet, CTRL_SIZE + 4)[0])
+    message = packet[CTRL_SIZE + 6:].decode()
+    print(f"[SERVER] Forwarded '{message}' from {client_addr}")
+    request, opts = split_options(message)
+    _, filename = request.split(maxsplit=1)
+    send_file_size(sock, client_addr, filename, opts, forwarded=True)
+
+def send_busy(sock, client_addr):
+    """Từ chối yêu cầu khi server quá tải, báo client chờ BUSY_RETRY_AFTER ms rồi gửi lại"""
+    print(f"[SERVER] Busy, rejecting request from {client_addr}")
+    sock.sendto(f"BUSY retry-after={BUSY_RETRY_AFTER}".encode(), client_addr)
+
+def send_packet(sock, client_addr, header, payload):
+    """
+    Gửi header và payload trong cùng một datagram bằng scatter/gather (sendmsg),
+    không phải nối header + payload thành bytes mới.
+    """
+    if HAS_SENDMSG:
+        sock.sendmsg([header, payload], [], 0, client_addr)
+    else:
+        # Windows không có sendmsg: buộc phải ghép lại thành một buffer
+        sock.sendto(header + bytes(payload), client_addr)
+
+# Các kích thước segment mà kernel đã từ chối gửi kiểu GSO (vd. lớn hơn MTU của card mạng)
+gso_failed_sizes = set()
+# Tăng mỗi lần send_probe_reply bật hoặc tắt cờ DF trên socket chính (số lẻ = đang bật)
+probe_df_epoch = 0
+
+def send_batch(sock, client_addr, packets):
+    """
+    Gửi danh sách (header, payload) với ít syscall nhất: các segment cùng kích thước liên
+    tiếp được ghép vào một sendmsg có UDP_SEGMENT (GSO), kernel tự cắt lại thành từng
+    datagram (segment cuối nhóm được phép ngắn hơn). Không có GSO thì gửi từng gói.
+    """
+    i = 0
+    while i < len(packets):
+        size = len(packets[i][0]) + len(packets[i][1])
+        j = i + 1
+        total = size
+        if HAS_UDP_GSO and size not in gso_failed_sizes:
+            while j < len(packets) and j - i < MAX_GSO_SEGMENTS:
+                next_size = len(packets[j][0]) + len(packets[j][1])
+                if next_size > size or total + next_size > MAX_GSO_BYTES:
+                    break
+                total += next_size
+                j += 1
+                if next_size < size:
+                    break
+        if j - i > 1:
+            buffers = [buf for packet in packets[i:j] for buf in packet]
+            epoch = probe_df_epoch
+            try:
+                sock.sendmsg(buffers, [(socket.SOL_UDP, UDP_SEGMENT, struct.pack("=H", size))], 0, client_addr)
+                i = j
+                continue
+            except OSError as e:
+                if e.errno == errno.EMSGSIZE and (epoch % 2 or epoch != probe_df_epoch):
+                    # Gửi đúng lúc PROBE bật DF trên socket này: chỉ nhóm này gửi lẻ, GSO vẫn dùng tiếp
+                    pass
+                else:
+                    print(f"[SERVER] UDP GSO failed for {size}-byte segments ({e}), sending one by one")
+                    gso_failed_sizes.add(size)
+        send_packet(sock, client_addr, *packets[i])
+        i += 1
+
+class MappedFile:
+    """Một file đã được mmap, dùng chung giữa các thread gửi chunk"""
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key          # (mtime, size) tại thời điểm mở file
+        self.refcount = 0
+        self.stale = False      # True khi đã bị loại khỏi cache nhưng còn thread dùng
+        self.mm = None
+        with open(path, "rb") as f:
+            if key[1] > 0:
+                # mmap giữ file descriptor riêng nên có thể đóng f ngay
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm) if self.mm is not None else memoryview(b"")
+
+    def close(self):
+        self.view.release()
+        if self.mm is not None:
+            self.mm.close()
+
+class FileCache:
+    """
+    Cache các file đã mmap, dùng chung cho mọi handle_chunk.
+    - Khóa theo đường dẫn, mỗi entry nhớ (mtime, size): file thay đổi thì mở lại.
+    - Đếm tham chiếu: entry chỉ được đóng khi không còn thread nào dùng.
+    - LRU: khi vượt max_open thì đóng các entry ít dùng nhất đang rảnh.
+    """
+    def __init__(self, max_open=MAX_OPEN_FILES):
+        self.max_open = max_open
+        self.entries = OrderedDict()  # path -> MappedFile
+        self.lock = threading.Lock()
+
+    def acquire(self, filename):
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.key == key:
+                self.entries.move_to_end(path)
+                entry.refcount += 1
+                return entry
+            if entry is not None:
+                # File đã thay đổi trên đĩa: bỏ mapping cũ khỏi cache
+                del self.entries[path]
+                self._retire(entry)
+            entry = MappedFile(path, key)
+            entry.refcount = 1
+            self.entries[path] = entry
+            self._evict()
+            return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.refcount -= 1
+            if entry.stale and entry.refcount == 0:
+                entry.close()
+
+    def _retire(self, entry):
+        entry.stale = True
+        if entry.refcount == 0:
+            entry.close()
+
+    def _evict(self):
+        # Các entry đang được dùng không thể đóng, nên số mapping có thể tạm vượt max_open
+        for path in list(self.entries):
+            if len(self.entries) <= self.max_open:
+                break
+            entry = self.entries[path]
+            if entry.refcount == 0:
+                del self.entries[path]
+                self._retire(entry)
+
+file_cache = FileCache()
+
+COMPRESSORS = {"zlib": lambda data, level: zlib.compress(data, level)}
+if lzma is not None:
+    COMPRESSORS["lzma"] = lambda data, level: lzma.compress(data, preset=min(level, 9))
+
+class CachedSegment:
+    """Payload dựng sẵn của một segment (None = gửi thẳng vùng mmap) và các checksum của nó"""
+    __slots__ = ("payload", "crc32", "md5", "tag64")
+
+    def __init__(self, payload=None):
+        self.payload = payload
+        self.crc32 = None  # Các checksum được tính lần đầu cần tới rồi dùng chung
+        self.md5 = None
+        self.tag64 = None
+
+class PacketCache:
+    """
+    Cache dùng chung các segment đã dựng sẵn, để nhiều client cùng tải một file không
+    phải tính lại checksum, nén hay parity cho cùng một segment.
+    - Khóa: (file, (mtime, size), offset trong file, độ dài, kiểu) với kiểu "raw", tên
+      thuật toán nén, hoặc ("parity", n, k, j, số segment của nhóm).
+    - Segment "raw" không giữ bản sao dữ liệu (mmap của FileCache đã dùng chung), chỉ giữ
+      checksum; segment nén/parity giữ payload.
+    - LRU theo tổng số byte (payload + PACKET_CACHE_ENTRY_COST mỗi entry), tối đa
+      PACKET_CACHE_BYTES; đếm hit/miss/evict để theo dõi.
+    - Mỗi file được đoán trước bằng COMPRESS_SAMPLES mẫu nén zlib mức 1: file nén không
+      được (zip, exe, video...) thì bỏ qua hẳn, không tốn CPU nén từng segment. Kết quả
+      nhớ theo LRU tối đa max_files file như FileCache.
+    """
+    def __init__(self, max_bytes=PACKET_CACHE_BYTES, max_files=MAX_OPEN_FILES):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.used = 0
+        self.entries = OrderedDict()  # khóa -> CachedSegment
+        self.files = OrderedDict()    # (path, file key) -> True nếu file đáng nén, Event khi đang lấy mẫu
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, entry, offset, length, kind, build=CachedSegment):
+        """CachedSegment của segment; lần đầu thì build() tạo (ngoài lock, vì có thể phải nén)"""
+        key = (entry.path, entry.key, offset, length, kind)
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+        cached = build()
+        with self.lock:
+            if key in self.entries:
+                return self.entries[key]  # Thread khác vừa dựng xong cùng segment
+            self.entries[key] = cached
+            self.used += self.cost(cached)
+            while self.used > self.max_bytes and len(self.entries) > 1:
+                _, old = self.entries.popitem(last=False)
+                self.used -= self.cost(old)
+                self.evictions += 1
+        return cached
+
+    def cost(self, cached):
+        return PACKET_CACHE_ENTRY_COST + (len(cached.payload) if cached.payload is not None else 0)
+
+    def compress(self, entry, offset, data, algorithm):
+        """Segment đã nén (payload None nếu nén không có lợi, khi đó gửi bản gốc)"""
+        def build():
+            packed = COMPRESSORS[algorithm](data, COMPRESSION_LEVEL)
+            return CachedSegment(packed if len(packed) <= len(data) * COMPRESS_MIN_RATIO else None)
+        return self.get(entry, offset, len(data), algorithm, build)
+
+    def worthwhile(self, entry):
+        file_key = (entry.path, entry.key)
+        with self.lock:
+            verdict = self.files.get(file_key)
+            if verdict is None:
+                # Đánh dấu đang lấy mẫu để các transfer bắt đầu cùng lúc không lấy mẫu lại
+                pending = self.files[file_key] = threading.Event()
+                self._evict_files()
+            else:
+                self.files.move_to_end(file_key)
+        if isinstance(verdict, threading.Event):
+            verdict.wait()
+            with self.lock:
+                return self.files.get(file_key) is True
+        if verdict is not None:
+            return verdict
+        verdict = False
+        try:
+            verdict = self.sample(entry.view) < COMPRESS_MIN_RATIO
+            print(f"[SERVER] '{os.path.basename(entry.path)}' is "
+                  f"{'compressible' if verdict else 'incompressible'}, "
+                  f"{'compressing' if verdict else 'sending raw'} segments")
+        finally:
+            with self.lock:
+                self.files[file_key] = verdict
+            pending.set()
+        return verdict
+
+    def _evict_files(self):
+        # File đang lấy mẫu (Event) còn có thread chờ nên giữ lại, như entry đang dùng của FileCache
+        for file_key in list(self.files):
+            if len(self.files) <= self.max_files:
+                break
+            if not isinstance(self.files[file_key], threading.Event):
+                del self.files[file_key]
+
+    def sample(self, view):
+        size = len(view)
+        if size == 0:
+            return 1.0
+        step = max(COMPRESS_SAMPLE_SIZE, size // COMPRESS_SAMPLES)
+        raw = packed = 0
+        for start in range(0, size, step):
+            with view[start:start + COMPRESS_SAMPLE_SIZE] as block:
+                raw += len(block)
+                packed += len(zlib.compress(block, 1))
+        return packed / raw
+
+    def stats(self):
+        total = self.hits + self.misses
+        return (f"packet cache: {len(self.entries)} segments, {self.used / 1e6:.1f}/{self.max_bytes / 1e6:.0f} MB, "
+                f"hit rate {self.hits / total if total else 0:.0%}, {self.evictions} evictions")
+
+packet_cache = PacketCache()
+
+class TransferTable:
+    """
+    Bảng điều phối của chế độ mux: transfer_id -> hàm xử lý gói điều khiển (ACK)
+    của transfer đó. Vòng lặp chính nhận mọi gói trên SERVER_PORT và chuyển
+    gói điều khiển tới đúng transfer qua bảng này. Byte cao của transfer_id là
+    WORKER_INDEX để bộ lọc reuseport đưa ACK về đúng process đang gửi.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.handlers = {}
+
+    def allocate(self):
+        with self.lock:
+            transfer_id = (WORKER_INDEX << 24) | self.next_id
+            self.next_id = self.next_id % 0xFFFFFF + 1
+            return transfer_id
+
+    def register(self, transfer_id, handler, client_ip=None):
+        """client_ip: chỉ nhận gói điều khiển từ IP này (None = mọi địa chỉ, như NACK multicast)"""
+        with self.lock:
+            self.handlers[transfer_id] = (handler, client_ip)
+
+    def unregister(self, transfer_id):
+        with self.lock:
+            self.handlers.pop(transfer_id, None)
+
+    def dispatch(self, packet, addr):
+        """
+        Chuyển gói điều khiển tới transfer; trả về False nếu transfer không còn hoặc gói
+        đến từ IP khác với client của transfer (transfer_id tăng dần nên dễ đoán).
+        """
+        if len(packet) < CTRL_SIZE:
+            return False
+        _, _, _, transfer_id = struct.unpack_from(CTRL_FORMAT, packet)
+        with self.lock:
+            handler, client_ip = self.handlers.get(transfer_id, (None, None))
+        if handler is None or (client_ip is not None and addr[0] != client_ip):
+            return False
+        handler(packet)
+        return True
+
+transfer_table = TransferTable()
+
+class ActiveParts:
+    """
+    Transfer đang chạy của mỗi part, theo (địa chỉ client, file, offset, size). Client gửi lại
+    CHUNK/RESEND cho cùng part từ cùng socket nghĩa là đã bỏ lần thử trước, nên transfer cũ
+    bị dừng thay vì tiếp tục phát lại và giữ chỗ trong cwnd chung của client.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transfers = {}
+
+    def register(self, key, transfer):
+        with self.lock:
+            old = self.transfers.get(key)
+            self.transfers[key] = transfer
+        if old is not None:
+            old.cancel()
+
+    def remove(self, key, transfer):
+        with self.lock:
+            if self.transfers.get(key) is transfer:
+                del self.transfers[key]
+
+    def __len__(self):
+        return len(self.transfers)
+
+active_parts = ActiveParts()
+
+class TokenBucket:
+    """
+    Token bucket giãn cách các lần gửi: token được nạp với tốc độ rate byte/giây,
+    tích tối đa burst byte. rate = 0 nghĩa là không giới hạn.
+    """
+    def __init__(self, rate=0, burst=PACING_BURST):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, size):
+        """Số giây phải chờ trước khi đủ token để gửi size byte"""
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            self.refill(time.monotonic())
+            needed = min(size, self.burst)
+            if self.tokens >= needed:
+                return 0.0
+            return (needed - self.tokens) / self.rate
+
+    def consume(self, size):
+        # Cho phép token âm: gói phát lại luôn được gửi ngay, các gói mới sẽ chờ bù lại
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self.refill(time.monotonic())
+            self.tokens -= size
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill(time.monotonic())
+            self.rate = rate
+
+global_pacer = TokenBucket(PACING_RATE)
+
+class CongestionController:
+    """
+    Cửa sổ chống nghẽn (cwnd, tính theo số segment) dùng chung cho mọi part của
+    một client. Lớp gốc không giới hạn gì (CONGESTION_CONTROL = "none"); các lớp con
+    thay đổi cwnd theo tín hiệu ACK và mất gói từ vòng lặp sliding window.
+    """
+    PACED = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cwnd = float(MAX_CWND)
+        self.inflight = 0       # Tổng số segment chưa có ACK của mọi part
+        self.last_loss = 0.0
+        self.srtt = None            # SRTT chung của client, cho transfer mới chưa có mẫu RTT
+        self.pacer = TokenBucket()  # Giãn cách gửi cho cả client theo cwnd/SRTT
+
+    def can_send(self):
+        return self.inflight < self.cwnd
+
+    def on_send(self, count=1):
+        with self.lock:
+            self.inflight += count
+
+    def on_ack(self, acked, rtt=None):
+        with self.lock:
+            self.inflight = max(0, self.inflight - acked)
+            if rtt is not None:
+                self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+            self.increase(acked, rtt)
+
+    def initial_rto(self):
+        """RTO ban đầu cho transfer mới: theo RTT đã đo của client thay vì TIMEOUT"""
+        if self.srtt is None:
+            return TIMEOUT
+        return min(TIMEOUT, max(MIN_RTO, 4 * self.srtt))
+
+    def on_loss(self, srtt=None):
+        """Mất gói: chỉ giảm cwnd một lần cho mỗi RTT dù nhiều segment cùng mất"""
+        now = time.monotonic()
+        with self.lock:
+            if srtt is not None and now - self.last_loss < srtt:
+                return
+            self.last_loss = now
+            self.decrease()
+            print(f"[SERVER] Congestion: cwnd reduced to {self.cwnd:.1f}")
+
+    def update_pacing(self, srtt, segment_size):
+        """Gửi đều cwnd segment trong mỗi SRTT thay vì dồn cả cửa sổ một lúc"""
+        if self.PACED and srtt:
+            self.pacer.set_rate(PACING_GAIN * self.cwnd * segment_size / srtt)
+
+    def on_release(self, count):
+        # Transfer kết thúc khi còn segment chưa ACK (client bỏ đi): trả lại phần cwnd đó
+        with self.lock:
+            self.inflight = max(0, self.inflight - count)
+
+    def increase(self, acked, rtt):
+        pass
+
+    def decrease(self):
+        pass
+
+class AimdController(CongestionController):
+    """AIMD kiểu TCP Reno: slow start tới ssthresh, sau đó +1 segment mỗi RTT; mất gói thì giảm một nửa"""
+    PACED = True
+
+    def __init__(self):
+        super().__init__()
+        self.cwnd = float(INITIAL_CWND)
+        self.ssthresh = float(MAX_CWND)
+
+    def increase(self, acked, rtt):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.cwnd += acked / self.cwnd
+        self.cwnd = min(self.cwnd, MAX_CWND)
+
+    def decrease(self):
+        self.ssthresh = max(self.cwnd / 2, MIN_CWND)
+        self.cwnd = self.ssthresh
+
+class DelayController(CongestionController):
+    """
+    Chống nghẽn theo độ trễ (kiểu TCP Vegas): so RTT hiện tại với RTT nhỏ nhất để
+    ước lượng số segment đang nằm trong hàng đợi; tăng cwnd khi hàng đợi ngắn hơn
+    ALPHA, giảm khi dài hơn BETA, mất gói thì giảm còn 70%.
+    """
+    ALPHA = 2
+    BETA = 6
+    PACED = True
+
+    def __init__(self):
+        super().__init__()
+        self.cwnd = float(INITIAL_CWND)
+        self.base_rtt = None
+        self.slow_start = True
+
+    def increase(self, acked, rtt):
+        if rtt is None or rtt <= 0:
+            return
+        if self.base_rtt is None or rtt < self.base_rtt:
+            self.base_rtt = rtt
+        queued = self.cwnd * (rtt - self.base_rtt) / rtt
+        if queued < self.ALPHA:
+            self.cwnd += acked if self.slow_start else acked / self.cwnd
+        else:
+            self.slow_start = False
+            if queued > self.BETA:
+                self.cwnd -= acked / self.cwnd
+        self.cwnd = min(max(self.cwnd, MIN_CWND), MAX_CWND)
+
+    def decrease(self):
+        self.slow_start = False
+        self.cwnd = max(self.cwnd * 0.7, MIN_CWND)
+
+CONGESTION_CONTROLLERS = {
+    "none": CongestionController,
+    "aimd": AimdController,
+    "delay": DelayController,
+}
+
+class CongestionRegistry:
+    """Mỗi địa chỉ IP client có một CongestionController dùng chung cho mọi part của client đó"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}  # ip -> [controller, số transfer đang dùng]
+
+    def acquire(self, client_ip):
+        with self.lock:
+            state = self.states.get(client_ip)
+            if state is None:
+                state = [CONGESTION_CONTROLLERS[CONGESTION_CONTROL](), 0]
+                self.states[client_ip] = state
+            state[1] += 1
+            return state[0]
+
+    def release(self, client_ip):
+        with self.lock:
+            state = self.states.get(client_ip)
+            if state is None:
+                return
+            state[1] -= 1
+            if state[1] <= 0:
+                del self.states[client_ip]
+
+congestion_registry = CongestionRegistry()
+
+class RttEstimator:
+    """
+    Ước lượng RTT của một transfer theo RFC 6298: SRTT/RTTVAR cập nhật từ mỗi mẫu,
+    RTO = SRTT + 4 * RTTVAR, nhân đôi RTO mỗi lần phải phát lại vì timeout.
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self, rto=TIMEOUT):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = rto
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def backoff(self):
+        self.rto = min(MAX_RTO, self.rto * 2)
+
+class AckQueue:
+    """
+    Thay cho socket phụ ở chế độ mux: engine thread đọc ACK từ hàng đợi này
+    với cùng giao diện settimeout/recvfrom như socket.
+    """
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.timeout = None
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def put(self, packet):
+        self.queue.put(packet)
+
+    def recvfrom(self, bufsize):
+        try:
+            return self.queue.get(timeout=self.timeout), None
+        except queue.Empty:
+            raise socket.timeout()
+
+manifest_locks = OrderedDict()  # Đường dẫn tuyệt đối -> Lock: hash một file lớn không chặn manifest của file khác
+manifest_locks_guard = threading.Lock()
+
+def manifest_lock(filename):
+    """Lock riêng cho manifest của một file; giữ LRU tối đa MAX_OPEN_FILES lock như FileCache"""
+    path = os.path.abspath(filename)
+    with manifest_locks_guard:
+        lock = manifest_locks.setdefault(path, threading.Lock())
+        manifest_locks.move_to_end(path)
+        # Lock đang bị giữ (đang hash file đó) thì không bỏ, kẻo hai thread cùng hash một file
+        for old in list(manifest_locks):
+            if len(manifest_locks) <= MAX_OPEN_FILES:
+                break
+            if old != path and not manifest_locks[old].locked():
+                del manifest_locks[old]
+        return lock
+
+def build_manifest(filename):
+    """
+    Tính manifest của file: kích thước, mtime, sha256 toàn file và hash (blake2b 8 byte)
+    của từng block MANIFEST_BLOCK_SIZE byte.
+    """
+    entry = file_cache.acquire(filename)
+    try:
+        whole = hashlib.sha256()
+        blocks = []
+        for start in range(0, len(entry.view), MANIFEST_BLOCK_SIZE):
+            block = entry.view[start:start + MANIFEST_BLOCK_SIZE]
+            whole.update(block)
+            blocks.append(hashlib.blake2b(block, digest_size=8).hexdigest())
+            block.release()
+        return {
+            "size": entry.key[1],
+            "mtime_ns": entry.key[0],
+            "sha256": whole.hexdigest(),
+            "block_size": MANIFEST_BLOCK_SIZE,
+            "blocks": blocks,
+        }
+    finally:
+        file_cache.release(entry)
+
+def load_manifest(filename):
+    """
+    Đọc manifest từ file index <filename>.manifest.json, chỉ tính lại khi
+    mtime hoặc kích thước file đã thay đổi.
+    """
+    sidecar = filename + MANIFEST_SUFFIX
+    with manifest_lock(filename):
+        st = os.stat(filename)
+        try:
+            with open(sidecar, "r") as f:
+                manifest = json.load(f)
+            if (manifest.get("size") == st.st_size and manifest.get("mtime_ns") == st.st_mtime_ns
+                    and manifest.get("block_size") == MANIFEST_BLOCK_SIZE):
+                return manifest
+        except (OSError, ValueError):
+            pass
+        print(f"[SERVER] Building manifest for '{filename}'")
+        manifest = build_manifest(filename)
+        try:
+            tmp_path = sidecar + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, sidecar)
+        except OSError as e:
+            # Thư mục chỉ đọc: vẫn trả manifest, lần sau tính lại
+            print(f"[SERVER] Cannot write manifest index '{sidecar}': {e}")
+        return manifest
+
+class FileCatalog:
+    """
+    Danh sách file giữ trong bộ nhớ cho LIST:
+    - nguồn là FILE_LIST, hoặc mọi file trong thư mục làm việc nếu CATALOG_SCAN_DIR;
+    - nguồn và metadata (kích thước, mtime) được kiểm tra nhiều nhất mỗi
+      CATALOG_CHECK_INTERVAL giây, nội dung trả lời chỉ dựng lại khi có thay đổi;
+    - sha256 lấy từ manifest và được tính trên một thread nền, LIST không phải chờ
+      hash file lớn; khi hash xong thì danh sách có version mới.
+    version là hash nội dung danh sách nên giống nhau giữa các worker và sau khi khởi động lại.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked = None       # Thời điểm (time.monotonic) kiểm tra nguồn gần nhất
+        self.source_key = None    # mtime của FILE_LIST/thư mục khi đọc self.names
+        self.names = []
+        self.hashes = {}          # (tên, mtime_ns, size) -> sha256
+        self.pending = set()      # Các khóa đang chờ thread nền tính hash
+        self.jobs = queue.Queue()
+        self.hasher = None
+        self.current = None       # (version, trả lời LIST cũ, JSON cho LIST ver=2)
+
+    def snapshot(self):
+        """(version, plain, payload) của danh sách hiện tại; None nếu không có nguồn"""
+        now = time.monotonic()
+        with self.lock:
+            if self.checked is None or now - self.checked >= CATALOG_CHECK_INTERVAL:
+                self.checked = now
+                self.refresh()
+            return self.current
+
+    def contains(self, filename):
+        """filename có trong danh sách đang phục vụ không (MANIFEST chỉ nhận các tên này)"""
+        self.snapshot()
+        with self.lock:
+            return filename in self.names
+
+    def refresh(self):
+        try:
+            source_key = os.stat("." if CATALOG_SCAN_DIR else FILE_LIST).st_mtime_ns
+            if source_key != self.source_key:
+                self.names = self.scan() if CATALOG_SCAN_DIR else self.read_list()
+                self.source_key = source_key
+        except OSError:
+            self.source_key = None
+            self.current = None
+            return
+        files = []
+        hashes = {}
+        for name in self.names:
+            try:
+                st = os.stat(name)
+            except OSError:
+                files.append({"name": name, "size": None, "mtime": None, "sha256": None})
+                continue
+            key = (name, st.st_mtime_ns, st.st_size)
+            sha256 = self.hashes.get(key)
+            if sha256 is None:
+                self.schedule_hash(key)
+            else:
+                hashes[key] = sha256
+            files.append({"name": name, "size": st.st_size, "mtime": int(st.st_mtime), "sha256": sha256})
+        self.hashes = hashes  # Bỏ hash của các file đã đổi hoặc không còn trong danh sách
+        listing = json.dumps(files, sort_keys=True).encode()
+        version = hashlib.blake2b(listing, digest_size=8).hexdigest()
+        if self.current is None or self.current[0] != version:
+            plain = "\n".join(self.names).encode()
+            payload = json.dumps({"version": version, "files": files}).encode()
+            self.current = (version, plain, payload)
+            print(f"[SERVER] File catalog updated: {len(files)} files (version {version})")
+
+    def read_list(self):
+        with open(FILE_LIST, "r") as f:
+            return [line.strip() for line in f if line.strip()]
+
+    def scan(self):
+        return sorted(entry.name for entry in os.scandir(".")
+                      if entry.is_file() and not entry.name.startswith(".")
+                      and not entry.name.endswith((MANIFEST_SUFFIX, ".tmp")))
+
+    def schedule_hash(self, key):
+        if key in self.pending:
+            return
+        self.pending.add(key)
+        self.jobs.put(key)
+        if self.hasher is None:
+            self.hasher = threading.Thread(target=self.hash_files, daemon=True)
+            self.hasher.start()
+
+    def hash_files(self):
+        # Một thread tính lần lượt để nhiều file lớn không cùng đọc đĩa một lúc
+        while True:
+            key = self.jobs.get()
+            name, mtime_ns, size = key
+            try:
+                manifest = load_manifest(name)
+            except (OSError, ValueError) as e:
+                print(f"[SERVER] Cannot hash '{name}' for the catalog: {e}")
+                manifest = {}
+            with self.lock:
+                self.pending.discard(key)
+                if manifest.get("mtime_ns") == mtime_ns and manifest.get("size") == size:
+                    self.hashes[key] = manifest["sha256"]
+                    self.checked = None  # LIST tiếp theo dựng lại danh sách có hash mới
+
+file_catalog = FileCatalog()
+
+def send_probe_reply(sock, client_addr, size):
+    """
+    Trả lời "PROBE <size>": gửi lại một datagram đúng size byte để client đo path MTU.
+    Trên Linux gói được đặt cờ DF nên gói lớn hơn MTU bị bỏ (hoặc kernel báo EMSGSIZE)
+    thay vì bị phân mảnh IP; khi đó trả "PROBE <size> TOOBIG" để client dừng tăng kích thước.
+    Gửi từ socket chính (cổng SERVER_PORT) để NAT/firewall cho phản hồi đi qua như mọi
+    phản hồi khác; cờ DF chỉ bật trong lúc gửi gói probe rồi trả lại như cũ. Linux không
+    có cờ DF theo từng lần gửi cho IPv4, còn socket thứ hai bind cùng cổng sẽ nhận cả gói
+    của client, nên lần gửi GSO trùng lúc bị EMSGSIZE được send_batch nhận ra qua
+    probe_df_epoch và chỉ gửi lẻ lần đó.
+    """
+    global probe_df_epoch
+    if size > SAFE_UDP_SIZE:
+        sock.sendto(f"PROBE {size} TOOBIG".encode(), client_addr)
+        return
+    reply = f"PROBE {size} OK ".encode()
+    previous = None
+    if HAS_PMTUDISC:
+        previous = sock.getsockopt(socket.IPPROTO_IP, socket.IP_MTU_DISCOVER)
+        probe_df_epoch += 1
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MTU_DISCOVER, socket.IP_PMTUDISC_DO)
+    try:
+        sock.sendto(reply.ljust(size, b"\0"), client_addr)
+    except BlockingIOError:
+        pass  # Socket non-blocking của engine asyncio đang đầy: coi như probe bị mất
+    except OSError as e:
+        print(f"[SERVER] Probe of {size} bytes to {client_addr} failed: {e}")
+        sock.sendto(f"PROBE {size} TOOBIG".encode(), client_addr)
+    finally:
+        if previous is not None:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MTU_DISCOVER, previous)
+            probe_df_epoch += 1
+
+def parse_ranges(text):
+    """
+    Tách danh sách khoảng seq "start-end,start-end" (không tính end) của lệnh RESEND.
+    Trả về None nếu có khoảng sai (không phải số, hoặc không thỏa 0 <= start < end).
+    """
+    ranges = []
+    for item in text.split(","):
+        start, sep, end = item.partition("-")
+        try:
+            start, end = int(start), int(end)
+        except ValueError:
+            return None
+        if not sep or start < 0 or start >= end:
+            return None
+        ranges.append((start, end))
+    return sorted(ranges)
+
+def send_paged(sock, client_addr, payload):
+    """
+    Gửi dữ liệu dài thành nhiều datagram, mỗi datagram có dòng đầu "PAGE <i> <n>"
+    để client ghép lại đúng thứ tự.
+    """
+    pages = [payload[i:i + MAX_REPLY_SIZE] for i in range(0, len(payload), MAX_REPLY_SIZE)] or [b""]
+    for i, page in enumerate(pages):
+        sock.sendto(f"PAGE {i} {len(pages)}\n".encode() + page, client_addr)
+
+def send_manifest(sock, client_addr, filename):
+    """Gửi manifest của file (JSON) cho client"""
+    # Chỉ nhận tên trong danh sách file: MANIFEST ghi file index cạnh file được hỏi
+    if not file_catalog.contains(filename) or not os.path.exists(filename):
+        sock.sendto(b"ERROR: File not found.", client_addr)
+        return
+    try:
+        manifest = load_manifest(filename)
+    except Exception as e:
+        sock.sendto(f"ERROR: {str(e)}".encode(), client_addr)
+        return
+    print(f"[SERVER] Sending manifest for '{filename}' to {client_addr}")
+    send_paged(sock, client_addr, json.dumps(manifest).encode())
+
+class ChunkTransfer:
+    """
+    Trạng thái gửi một part [offset, offset + size) theo cơ chế sliding window.
+    Lớp này không gắn với socket hay thread nào: engine thread
+    (send_chunk_part_sliding_window) và engine asyncio (AsyncChunkSender) đều dùng nó.
+
+    Mmap của file lấy từ file_cache, mỗi gói chỉ là một memoryview trỏ vào vùng mmap
+    nên không copy dữ liệu file. Segment được tạo khi cửa sổ trượt tới (không dựng sẵn
+    cả danh sách), inflight chỉ giữ các gói đã gửi mà chưa có ACK để phát lại khi timeout.
+
+    Header v1 của mỗi gói được định nghĩa theo định dạng:
       - part_id: 4 byte (unsigned int)
       - sequence_number: 4 byte (unsigned int)
       - total_segments: 4 byte (unsigned int)
       - checksum: 32 byte (MD5 hex string của dữ liệu gói)
+
+    Header v2 (khi client gửi ver=2) là header nhị phân 20 byte:
+      - version: 1 byte, flags: 1 byte, header_len: 2 byte
+      - part_id, sequence_number, total_segments: mỗi trường 4 byte
+      - crc32: 4 byte (CRC-32 của dữ liệu gói)
+      - nếu flags có FLAG_MUX (mux=1): thêm transfer_id 4 byte sau header
+      - nếu flags có FLAG_TAG64 (sum=tag64): thêm tag blake2b 8 byte ở cuối header
+      - nếu flags có FLAG_COMPRESSED (comp=zlib|lzma): dữ liệu là bản nén của segment,
+        crc32/tag tính trên bản nén; segment nén không có lợi thì gửi nguyên bản
+
+    FEC (CHUNK kèm fec=n:k): sau segment cuối của mỗi nhóm n segment liên tiếp, gửi thêm
+    k gói parity cùng kích thước với flags FLAG_PARITY. Parity j của nhóm g là XOR các
+    segment g*n + j, g*n + j + k, ... (xen kẽ, nên k gói mất liền nhau vẫn nằm ở k lớp khác
+    nhau); client tự dựng lại segment mất mà không cần chờ phát lại. Parity không được ACK
+    hay phát lại và không chiếm cwnd, chỉ tốn token pacing.
     """
+    WINDOW_SIZE = 20000
+
+    def __init__(self, filename, offset, size, part_id, client_addr, opts=None, transfer_id=0):
+        self.part_id = part_id
+        self.client_addr = client_addr
+        self.transfer_id = transfer_id
+        self.accepted = negotiate_options(opts or {}, client_addr[0])
+        self.version = int(self.accepted.get("ver", 1))
+        self.use_tag64 = self.accepted.get("sum") == "tag64"
+        self.mux = self.accepted.get("mux") == "1"
+        self.sack = self.accepted.get("sack") == "1"
+        self.flags = (FLAG_TAG64 if self.use_tag64 else 0) | (FLAG_MUX if self.mux else 0)
+        self.fec = parse_fec(self.accepted.get("fec"))
+        self.compression = self.accepted.get("comp")
+        if self.version >= 2:
+            self.header_len = (HEADER_V2_SIZE + (TAG64_SIZE if self.use_tag64 else 0)
+                               + (TRANSFER_ID_SIZE if self.mux else 0))
+        else:
+            self.header_len = HEADER_SIZE
+        # Client v2 có thể thỏa thuận gói nhỏ hơn (seg=) để không bị phân mảnh IP
+        self.segment_size = int(self.accepted.get("seg", SAFE_UDP_SIZE))
+        self.data_size = self.segment_size - self.header_len
+
+        self.entry = file_cache.acquire(filename)
+        self.offset = offset
+        self.chunk_view = self.entry.view[offset:offset + size]
+        if self.compression and not packet_cache.worthwhile(self.entry):
+            self.compression = None
+        self.total_segments = (len(self.chunk_view) + self.data_size - 1) // self.data_size
+        self.base = 0        # Chỉ số gói đầu của cửa sổ
+        self.next_seq = 0    # Chỉ số gói tiếp theo cần gửi
+        self.inflight = {}   # seq -> (header, payload) đã gửi nhưng chưa có ACK
+        self.sent_at = {}    # seq -> thời điểm gửi gần nhất, giữ theo thứ tự thời gian gửi
+        self.retransmitted = set()  # Các seq đã phát lại: không lấy mẫu RTT (thuật toán Karn)
+        self.last_progress = time.monotonic()
+        self.stalled_rtos = 0   # Số lần RTO liên tiếp từ ACK mới gần nhất
+        self.gave_up = False
+        self.fast_retransmit = []   # Các seq bị coi là mất qua SACK, phát lại ở lần fill_window tới
+        self.cc_blocked = False     # fill_window vừa dừng vì cwnd chung của client đã đầy
+        self.cc = congestion_registry.acquire(client_addr[0])
+        self.rtt = RttEstimator(self.cc.initial_rto())
+        self.pace_until = None      # fill_window vừa dừng vì hết token, gửi tiếp từ thời điểm này
+        self.pacers = (TokenBucket(PART_PACING_RATE), self.cc.pacer, global_pacer)
+        print(f"[SERVER] Part {part_id}: Total segments = {self.total_segments} (wire v{self.version})")
+        # RESEND: chỉ gửi các seq client còn thiếu, các seq khác coi như đã được ACK
+        self.resend_ranges = None
+        if opts and "ranges" in opts:
+            self.resend_ranges = opts["ranges"]
+            count = sum(max(0, min(end, self.total_segments) - start) for start, end in self.resend_ranges)
+            print(f"[SERVER] Part {part_id}: Resending {count}/{self.total_segments} segments")
+            self.fec = None  # Các seq còn thiếu nằm rải rác, nhóm FEC không còn ý nghĩa
+        self.part_key = (client_addr, filename, offset, size)
+        active_parts.register(self.part_key, self)
+
+    @property
+    def done(self):
+        return self.base >= self.total_segments or self.gave_up
+
+    def segment_data(self, seq):
+        start = seq * self.data_size
+        return self.chunk_view[start:start + self.data_size]
+
+    def build_header(self, seq, payload, flags, cached):
+        # Checksum của segment được tính một lần và lưu trong packet_cache cho mọi transfer
+        if cached.crc32 is None:
+            cached.crc32 = zlib.crc32(payload)
+        header = struct.pack(HEADER_V2_FORMAT, self.version, flags, self.header_len,
+                             self.part_id, seq, self.total_segments, cached.crc32)
+        if self.mux:
+            header += struct.pack("!I", self.transfer_id)
+        if self.use_tag64:
+            if cached.tag64 is None:
+                cached.tag64 = compute_tag64(payload)
+            header += cached.tag64
+        return header
+
+    def build_segment(self, seq):
+        # Chỉ lưu header và memoryview của dữ liệu, không copy payload
+        segment_data = self.segment_data(seq)
+        file_offset = self.offset + seq * self.data_size
+        if self.compression:
+            cached = packet_cache.compress(self.entry, file_offset, segment_data, self.compression)
+            if cached.payload is not None:
+                segment_data.release()
+                # memoryview để acknowledge()/close() giải phóng giống payload chưa nén
+                packed = memoryview(cached.payload)
+                return self.build_header(seq, packed, self.flags | FLAG_COMPRESSED, cached), packed
+        cached = packet_cache.get(self.entry, file_offset, len(segment_data), "raw")
+        if self.version >= 2:
+            header = self.build_header(seq, segment_data, self.flags, cached)
+        else:
+            if cached.md5 is None:
+                cached.md5 = hashlib.md5(segment_data).hexdigest().encode()  # 32 ký tự hex
+            header = struct.pack(HEADER_FORMAT, self.part_id, seq, self.total_segments, cached.md5)
+        return header, segment_data
+
+    def build_parity(self, group):
+        """k gói parity của nhóm group (xem docstring của lớp)"""
+        n, k = self.fec
+        first = group * n
+        end = min(first + n, self.total_segments)
+        group_offset = self.offset + first * self.data_size
+        group_bytes = min(end * self.data_size, len(self.chunk_view)) - first * self.data_size
+        packets = []
+        for j in range(min(k, end - first)):
+            def build(j=j):
+                members = [self.segment_data(seq) for seq in range(first + j, end, k)]
+                return CachedSegment(xor_parity(members, self.data_size))
+            cached = packet_cache.get(self.entry, group_offset, group_bytes, ("parity", n, k, j, self.data_size), build)
+            packets.append((self.build_header(group * k + j, cached.payload, self.flags | FLAG_PARITY, cached),
+                            cached.payload))
+        return packets
+
+    def fill_window(self):
+        """
+        Trả về danh sách (header, payload) cần gửi: trước hết các segment mất cần phát lại
+        nhanh, sau đó tạo gói mới cho tới khi đầy cửa sổ của part hoặc cwnd chung của client,
+        hoặc cho tới khi một trong các token bucket (part, client, toàn server) hết token.
+        """
+        if self.gave_up:
+            return []
+        now = time.monotonic()
+        packets = [self.retransmit(seq, now) for seq in self.fast_retransmit if seq in self.inflight]
+        self.fast_retransmit = []
+        self.cc_blocked = False
+        self.pace_until = None
+        if self.stalled_rtos:
+            # Đang chờ ACK cho lần phát lại sau RTO: không lấy thêm chỗ trong cwnd chung cho
+            # segment mới, nếu không transfer client đã bỏ sẽ chiếm hết cwnd của các part khác
+            return packets
+        while self.next_seq < self.total_segments and self.next_seq < self.base + self.WINDOW_SIZE:
+            if self.resend_ranges is not None:
+                wanted = self.next_wanted(self.next_seq)
+                if wanted != self.next_seq:
+                    # Nhảy qua các seq client đã có, base trượt theo vì chúng không nằm trong inflight
+                    self.next_seq = wanted
+                    self.advance_base()
+                    continue
+            if not self.cc.can_send():
+                self.cc_blocked = True
+                break
+            wait = max(pacer.delay(self.segment_size) for pacer in self.pacers)
+            if wait > 0:
+                self.pace_until = time.monotonic() + wait
+                break
+            packet = self.build_segment(self.next_seq)
+            self.consume_tokens(packet)
+            self.inflight[self.next_seq] = packet
+            self.sent_at[self.next_seq] = time.monotonic()
+            self.cc.on_send()
+            if VERBOSE:
+                print(f"[SERVER] Sending part {self.part_id}, seq {self.next_seq} to {self.client_addr}")
+            packets.append(packet)
+            self.next_seq += 1
+            if self.fec and (self.next_seq % self.fec[0] == 0 or self.next_seq == self.total_segments):
+                # Vừa gửi segment cuối của một nhóm: gửi kèm parity của nhóm
+                for parity in self.build_parity((self.next_seq - 1) // self.fec[0]):
+                    self.consume_tokens(parity)
+                    packets.append(parity)
+        return packets
+
+    def next_wanted(self, seq):
+        """Seq nhỏ nhất >= seq nằm trong các khoảng RESEND (total_segments nếu không còn)"""
+        for start, end in self.resend_ranges:
+            if seq < end:
+                return min(max(seq, start), self.total_segments)
+        return self.total_segments
+
+    def retransmit(self, seq, now):
+        if VERBOSE:
+            print(f"[SERVER] Resending part {self.part_id}, seq {seq}")
+        # Đưa seq xuống cuối để sent_at vẫn theo thứ tự thời gian gửi
+        del self.sent_at[seq]
+        self.sent_at[seq] = now
+        if seq not in self.retransmitted:
+            # Bản gốc coi như đã mất khỏi mạng: trả lại chỗ trong cwnd chung, nếu không
+            # transfer mà client đã bỏ sẽ giữ cwnd cho tới TRANSFER_IDLE_LIMIT
+            self.cc.on_release(1)
+            self.retransmitted.add(seq)
+        self.consume_tokens(self.inflight[seq])
+        return self.inflight[seq]
+
+    def consume_tokens(self, packet):
+        size = len(packet[0]) + len(packet[1])
+        for pacer in self.pacers:
+            pacer.consume(size)
+
+    def on_ack(self, ack_packet):
+        """
+        Xử lý một gói ACK: part_id và sequence_number (8 byte), hoặc gói điều khiển
+        CTRL_ACK (transfer_id và sequence_number) / CTRL_SACK (ACK gộp) với client v2.
+        Trả về True nếu có segment mới được ACK, tức là có thể gửi thêm gói mới.
+        """
+        if len(ack_packet) < 8:
+            print("[SERVER] Received incomplete ACK packet")
+            return False
+        try:
+            if (self.mux or self.sack) and ack_packet[0] == CTRL_MAGIC:
+                _, ctrl_type, count, transfer_id = struct.unpack_from(CTRL_FORMAT, ack_packet)
+                if self.mux and transfer_id != self.transfer_id:
+                    return False
+                if ctrl_type == CTRL_SACK:
+                    return self.on_sack(ack_packet, count)
+                if ctrl_type != CTRL_ACK:
+                    return False
+                ack_part = self.part_id
+                (ack_seq,) = struct.unpack_from("!I", ack_packet, CTRL_SIZE)
+            else:
+                ack_part, ack_seq = struct.unpack("!II", ack_packet)
+        except struct.error:
+            print("[SERVER] Error unpacking ACK")
+            return False
+        if VERBOSE:
+            print(f"[SERVER] Received ACK for part {ack_part}, seq {ack_seq} from {self.client_addr}")
+        if ack_part != self.part_id or ack_seq not in self.inflight:
+            return False
+        _, sent = self.acknowledge(ack_seq)
+        if sent is not None:
+            rtt = time.monotonic() - sent
+            self.rtt.sample(rtt)
+            self.cc.on_ack(1, rtt)
+            self.cc.update_pacing(self.rtt.srtt, self.segment_size)
+        self.advance_base()
+        return True
+
+    def acknowledge(self, seq):
+        """
+        Bỏ seq khỏi inflight. Trả về (acked, sent): acked là False nếu seq không còn
+        trong inflight; sent là thời điểm gửi để lấy mẫu RTT, None nếu seq đã từng phát lại.
+        """
+        packet = self.inflight.pop(seq, None)
+        if packet is None:
+            return False, None
+        packet[1].release()
+        self.last_progress = time.monotonic()
+        self.stalled_rtos = 0
+        sent = self.sent_at.pop(seq)
+        if seq in self.retransmitted:
+            self.retransmitted.discard(seq)
+            return True, None
+        return True, sent
+
+    def on_sack(self, ack_packet, count):
+        """
+        ACK gộp: mọi seq < cum đã nhận, cộng thêm count khoảng [start, end) đã nhận phía trên cum.
+        """
+        (cum,) = struct.unpack_from("!I", ack_packet, CTRL_SIZE)
+        ranges = [struct.unpack_from("!II", ack_packet, CTRL_SIZE + 4 + 8 * i) for i in range(count)]
+        if VERBOSE:
+            print(f"[SERVER] Received SACK for part {self.part_id}: cum {cum}, ranges {ranges} from {self.client_addr}")
+        # inflight được thêm theo thứ tự seq tăng dần
+        results = []
+        for seq in list(self.inflight):
+            if seq >= cum:
+                break
+            results.append(self.acknowledge(seq))
+        for start, end in ranges:
+            for seq in range(start, min(end, self.next_seq)):
+                results.append(self.acknowledge(seq))
+        acked = sum(1 for ok, _ in results if ok)
+        # Một mẫu RTT cho mỗi ACK gộp, lấy theo segment được gửi gần nhất.
+        # Segment đã phát lại không còn chiếm cwnd nên không tính vào on_ack
+        sent_times = [sent for _, sent in results if sent is not None]
+        if sent_times:
+            rtt = time.monotonic() - max(sent_times)
+            self.rtt.sample(rtt)
+            self.cc.on_ack(len(sent_times), rtt)
+            self.cc.update_pacing(self.rtt.srtt, self.segment_size)
+        # Đã có DUP_THRESH segment phía sau được SACK: coi các segment còn thiếu là mất
+        # và phát lại ngay thay vì chờ RTO (chỉ lần đầu, lần sau để RTO lo)
+        if ranges:
+            highest = max(end for _, end in ranges) - 1
+            lost = []
+            for seq in self.inflight:
+                if seq + DUP_THRESH > highest:
+                    break
+                if seq not in self.retransmitted and seq not in self.fast_retransmit:
+                    lost.append(seq)
+            if lost:
+                self.fast_retransmit.extend(lost)
+                self.cc.on_loss(self.rtt.srtt)
+        # Client đã có sẵn các seq < cum (từ lần thử trước) thì không cần gửi nữa
+        if cum > self.next_seq:
+            self.next_seq = min(cum, self.total_segments)
+        self.advance_base()
+        return acked > 0 or bool(self.fast_retransmit)
+
+    def advance_base(self):
+        # Các seq < next_seq không còn trong inflight là đã được ACK
+        old_base = self.base
+        while self.base < self.next_seq and self.base not in self.inflight:
+            self.base += 1
+        if self.base == old_base:
+            return False
+        if VERBOSE:
+            print(f"[SERVER] Updated base for part {self.part_id} is now {self.base}")
+        return True
+
+    def next_deadline(self):
+        """Thời điểm (time.monotonic) segment gửi sớm nhất chưa có ACK sẽ quá RTO"""
+        for sent in self.sent_at.values():
+            return sent + self.rtt.rto
+        return None
+
+    def time_to_deadline(self):
+        deadline = self.next_deadline()
+        timeout = TIMEOUT if deadline is None else max(0.001, deadline - time.monotonic())
+        if self.cc_blocked:
+            # cwnd chung có thể được part khác giải phóng bất cứ lúc nào
+            timeout = min(timeout, CC_POLL_INTERVAL)
+        if self.pace_until is not None:
+            timeout = min(timeout, max(0.001, self.pace_until - time.monotonic()))
+        return timeout
+
+    def on_timeout(self):
+        """Trả về các gói đã quá RTO mà chưa có ACK để gửi lại (không gửi lại cả cửa sổ)"""
+        if self.gave_up:
+            return []
+        now = time.monotonic()
+        if now - self.last_progress > TRANSFER_IDLE_LIMIT:
+            print(f"[SERVER] Part {self.part_id}: no ACK for {TRANSFER_IDLE_LIMIT}s, giving up")
+            self.gave_up = True
+            return []
+        overdue = []
+        for seq, sent in self.sent_at.items():
+            if now - sent < self.rtt.rto:
+                break  # sent_at theo thứ tự thời gian gửi nên các seq sau chưa quá hạn
+            overdue.append(seq)
+        if not overdue:
+            return []
+        self.stalled_rtos += 1
+        if self.stalled_rtos > MAX_STALLED_RTOS:
+            # Client nhiều khả năng đã bỏ part này: dừng để engine đóng transfer, trả cwnd
+            # và luồng cho các transfer còn sống thay vì chờ tới TRANSFER_IDLE_LIMIT
+            print(f"[SERVER] Part {self.part_id}: {MAX_STALLED_RTOS} timeouts without ACK, giving up")
+            self.gave_up = True
+            return []
+        print(f"[SERVER] Timeout waiting for ACK for part {self.part_id}: "
+              f"{len(overdue)} segments overdue (rto {self.rtt.rto:.3f}s)")
+        packets = [self.retransmit(seq, now) for seq in overdue]
+        if self.stalled_rtos == 1 and self.rtt.srtt is not None:
+            # Chỉ lần RTO đầu của một đợt mất ACK mới giảm cwnd chung; transfer chưa từng có
+            # ACK (client đã bỏ) và các lần backoff sau không kéo cwnd của part khác xuống
+            self.cc.on_loss(self.rtt.srtt)
+        self.rtt.backoff()
+        return packets
+
+    def cancel(self):
+        """Client đã yêu cầu lại part này: dừng ở lần thức dậy tiếp theo của engine"""
+        print(f"[SERVER] Part {self.part_id}: superseded by a new request, stopping")
+        self.gave_up = True
+
+    def close(self):
+        active_parts.remove(self.part_key, self)
+        # Phải giải phóng mọi memoryview trước khi trả mmap về cache
+        for _, segment_data in self.inflight.values():
+            segment_data.release()
+        self.cc.on_release(sum(1 for seq in self.inflight if seq not in self.retransmitted))
+        congestion_registry.release(self.client_addr[0])
+        self.inflight.clear()
+        self.chunk_view.release()
+        file_cache.release(self.entry)
+        if VERBOSE:
+            print(f"[SERVER] Part {self.part_id}: {packet_cache.stats()}")
+
+class MulticastSession:
+    """
+    Phiên phát một file tới nhóm multicast: các segment được phát một lượt theo thứ tự
+    và mọi client trong nhóm nhận cùng một datagram, nên lưu lượng ra của server không
+    tăng theo số client. Client gửi NACK (gói điều khiển CTRL_NACK, unicast tới
+    SERVER_PORT) cho các seq mình thiếu; các seq đó được phát lại trên nhóm, mỗi seq một
+    lần dù nhiều client cùng thiếu. Gói dùng header v2 với part_id là session_id.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entry = file_cache.acquire(filename)
+        self.data_size = MULTICAST_SEGMENT_SIZE - HEADER_V2_SIZE
+        self.total_segments = (len(self.entry.view) + self.data_size - 1) // self.data_size
+        self.next_seq = 0             # Seq tiếp theo của lượt phát đầu
+        self.repairs = deque()        # Seq bị NACK chờ phát lại
+        self.repair_set = set()
+        self.wakeup = threading.Condition()
+        self.last_activity = time.monotonic()
+        self.finished = False
+        self.pacer = TokenBucket(MULTICAST_RATE)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(MULTICAST_INTERFACE))
+        self.session_id = transfer_table.allocate()
+        transfer_table.register(self.session_id, self.on_nack)
+        print(f"[SERVER] Multicast session {self.session_id} for '{filename}': "
+              f"{self.total_segments} segments to {MULTICAST_GROUP}:{MULTICAST_PORT}")
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def touch(self):
+        """Client mới tham gia: giữ phiên sống; False nếu phiên đã kết thúc"""
+        with self.wakeup:
+            if self.finished:
+                return False
+            self.last_activity = time.monotonic()
+            return True
+
+    def on_nack(self, packet):
+        try:
+            _, ctrl_type, count, _ = struct.unpack_from(CTRL_FORMAT, packet)
+            ranges = [struct.unpack_from("!II", packet, CTRL_SIZE + 8 * i) for i in range(count)]
+        except struct.error:
+            return
+        if ctrl_type != CTRL_NACK:
+            return
+        with self.wakeup:
+            for start, end in ranges:
+                # Seq chưa tới lượt phát đầu thì đằng nào cũng sẽ được phát
+                for seq in range(start, min(end, self.next_seq)):
+                    if seq not in self.repair_set:
+                        self.repair_set.add(seq)
+                        self.repairs.append(seq)
+            self.last_activity = time.monotonic()
+            self.wakeup.notify()
+
+    def next_segment(self):
+        """Seq cần phát tiếp theo (ưu tiên phát lại), None khi phiên kết thúc"""
+        with self.wakeup:
+            while True:
+                if self.repairs:
+                    seq = self.repairs.popleft()
+                    self.repair_set.discard(seq)
+                    return seq
+                if self.next_seq < self.total_segments:
+                    self.next_seq += 1
+                    return self.next_seq - 1
+                idle = time.monotonic() - self.last_activity
+                if idle >= MULTICAST_LINGER:
+                    self.finished = True
+                    return None
+                self.wakeup.wait(MULTICAST_LINGER - idle)
+
+    def build_segment(self, seq):
+        start = seq * self.data_size
+        segment_data = self.entry.view[start:start + self.data_size]
+        cached = packet_cache.get(self.entry, start, len(segment_data), "raw")
+        if cached.crc32 is None:
+            cached.crc32 = zlib.crc32(segment_data)
+        header = struct.pack(HEADER_V2_FORMAT, 2, 0, HEADER_V2_SIZE, self.session_id, seq,
+                             self.total_segments, cached.crc32)
+        return header, segment_data
+
+    def run(self):
+        time.sleep(MULTICAST_JOIN_DELAY)
+        sent = 0
+        try:
+            while True:
+                seq = self.next_segment()
+                if seq is None:
+                    break
+                header, segment_data = self.build_segment(seq)
+                size = len(header) + len(segment_data)
+                wait = max(pacer.delay(size) for pacer in (self.pacer, global_pacer))
+                if wait > 0:
+                    time.sleep(wait)
+                for pacer in (self.pacer, global_pacer):
+                    pacer.consume(size)
+                send_packet(self.sock, (MULTICAST_GROUP, MULTICAST_PORT), header, segment_data)
+                segment_data.release()
+                sent += 1
+        finally:
+            multicast_sessions.remove(self)
+            transfer_table.unregister(self.session_id)
+            self.sock.close()
+            file_cache.release(self.entry)
+            print(f"[SERVER] Multicast session {self.session_id} finished: {sent} datagrams "
+                  f"for {self.total_segments} segments")
+
+class MulticastRegistry:
+    """Phiên multicast đang chạy của mỗi file: client tải cùng file vào chung một phiên"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def join(self, filename):
+        with self.lock:
+            session = self.sessions.get(filename)
+            if session is None or not session.touch():
+                session = MulticastSession(filename)
+                self.sessions[filename] = session
+            return session
+
+    def remove(self, session):
+        with self.lock:
+            if self.sessions.get(session.filename) is session:
+                del self.sessions[session.filename]
+
+multicast_sessions = MulticastRegistry()
+
+def send_chunk_part_sliding_window(sock, client_addr, filename, offset, size, part_id, opts=None,
+                                   ack_source=None, transfer_id=0):
+    """
+    Engine thread: gửi một part qua socket sock, chặn cho tới khi client ACK hết.
+    ACK được đọc từ ack_source (mặc định là chính sock; AckQueue ở chế độ mux).
+    """
+    if ack_source is None:
+        ack_source = sock
     try:
-        with open(filename, "rb") as f:
-            f.seek(offset)
-            chunk_data = f.read(size)
+        transfer = ChunkTransfer(filename, offset, size, part_id, client_addr, opts, transfer_id)
     except Exception as e:
         error_msg = f"ERROR: {str(e)}"
         print(f"[SERVER] {error_msg}")
         sock.sendto(error_msg.encode(), client_addr)
         return
-
-    HEADER_FORMAT = "!III32s"  # part_id, sequence_number, total_segments, checksum
-    HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
-    SAFE_UDP_SIZE = 20000     # Kích thước tối đa gói UDP an toàn (điều chỉnh theo môi trường)
-    DATA_SIZE = SAFE_UDP_SIZE - HEADER_SIZE
-
-    total_segments = (len(chunk_data) + DATA_SIZE - 1) // DATA_SIZE
-    print(f"[SERVER] Part {part_id}: Total segments = {total_segments}")
-
-    # Tạo danh sách các gói (segment)
-    segments = []
-    for seq in range(total_segments):
-        start = seq * DATA_SIZE
-        end = start + DATA_SIZE
-        segment_data = chunk_data[start:end]
-        chksum = hashlib.md5(segment_data).hexdigest()  # 32 ký tự hex
-        header = struct.pack(HEADER_FORMAT, part_id, seq, total_segments, chksum.encode())
-        packet = header + segment_data
-        segments.append(packet)
-
-    # Cơ chế sliding window
-    WINDOW_SIZE = 20000
-    base = 0        # Chỉ số gói đầu của cửa sổ
-    next_seq = 0    # Chỉ số gói tiếp theo cần gửi
-    acked = [False] * total_segments
-
-    sock.settimeout(TIMEOUT)
-    while base < total_segments:
-        # Gửi tất cả các gói trong cửa sổ
-        while next_seq < total_segments and next_seq < base + WINDOW_SIZE:
-            print(f"[SERVER] Sending part {part_id}, seq {next_seq} to {client_addr}")
-            sock.sendto(segments[next_seq], client_addr)
-            next_seq += 1
-        try:
-            # Nhận ACK từ client: ACK gồm part_id và sequence_number (8 byte)
-            while True:
-                ack_packet, _ = sock.recvfrom(1024)
-                if len(ack_packet) < 8:
-                    print("[SERVER] Received incomplete ACK packet")
-                    continue
-                try:
-                    ack_part, ack_seq = struct.unpack("!II", ack_packet)
-                except struct.error:
-                    print("[SERVER] Error unpacking ACK")
-                    continue
-                print(f"[SERVER] Received ACK for part {ack_part}, seq {ack_seq} from {client_addr}")
-                if ack_part != part_id:
-                    continue
-                if ack_seq < total_segments:
-                    acked[ack_seq] = True
-                    while base < total_segments and acked[base]:
-                        base += 1
-                    print(f"[SERVER] Updated base for part {part_id} is now {base}")
-                    if base >= total_segments:
+    try:
+        while not transfer.done:
+            send_batch(sock, client_addr, transfer.fill_window())
+            try:
+                # Nhận ACK cho tới khi cửa sổ trượt thì quay lại gửi các gói mới;
+                # chỉ chờ tới lúc segment cũ nhất quá RTO
+                while True:
+                    ack_source.settimeout(transfer.time_to_deadline())
+                    ack_packet, ack_addr = ack_source.recvfrom(1024)
+                    # Socket phụ nhận được gói từ bất kỳ ai: bỏ ACK không đến từ client
+                    if ack_addr is not None and ack_addr[0] != client_addr[0]:
+                        continue
+                    if transfer.on_ack(ack_packet):
                         break
-        except socket.timeout:
-            print(f"[SERVER] Timeout waiting for ACK for part {part_id} in window [{base}, {min(base+WINDOW_SIZE, total_segments)})")
-            # Nếu hết timeout, resend các gói chưa ACK trong cửa sổ
-            for seq in range(base, min(base + WINDOW_SIZE, total_segments)):
-                if not acked[seq]:
-                    print(f"[SERVER] Resending part {part_id}, seq {seq}")
-                    sock.sendto(segments[seq], client_addr)
-    sock.settimeout(None)
-    print(f"[SERVER] Completed sending part {part_id}")
+            except socket.timeout:
+                send_batch(sock, client_addr, transfer.on_timeout())
+        ack_source.settimeout(None)
+        if not transfer.gave_up:
+            print(f"[SERVER] Completed sending part {part_id}")
+    except Exception as e:
+        error_msg = f"ERROR: {str(e)}"
+        print(f"[SERVER] {error_msg}")
+        sock.sendto(error_msg.encode(), client_addr)
+    finally:
+        transfer.close()
 
-def handle_chunk(filename, offset, size, part_id, client_addr):
+def handle_chunk(filename, offset, size, part_id, client_addr, opts=None):
     """
-    Hàm chạy trên thread riêng: tạo socket phụ và gửi chunk qua cơ chế sliding window.
+    Hàm chạy trên một thread của executor: tạo socket phụ và gửi chunk qua cơ chế sliding window.
     """
     sock_chunk = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock_chunk.bind(("0.0.0.0", 0))  # OS cấp cổng ngẫu nhiên
     print(f"[SERVER] Handling part {part_id} on socket {sock_chunk.getsockname()}")
-    send_chunk_part_sliding_window(sock_chunk, client_addr, filename, offset, size, part_id)
+    send_chunk_part_sliding_window(sock_chunk, client_addr, filename, offset, size, part_id, opts)
     sock_chunk.close()
 
-def main():
-    sock_main = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock_main.bind((SERVER_IP, SERVER_PORT))
-    print(f"[SERVER] Server listening on {SERVER_IP}:{SERVER_PORT}")
+def handle_chunk_mux(sock_main, filename, offset, size, part_id, client_addr, opts):
+    """
+    Chế độ mux: gửi chunk ngay trên socket chính (cổng SERVER_PORT), ACK được
+    vòng lặp chính chuyển tới qua transfer_table nên không tốn thêm socket nào.
+    """
+    transfer_id = transfer_table.allocate()
+    acks = AckQueue()
+    transfer_table.register(transfer_id, acks.put, client_addr[0])
+    print(f"[SERVER] Handling part {part_id} as transfer {transfer_id} on main socket")
+    try:
+        send_chunk_part_sliding_window(sock_main, client_addr, filename, offset, size, part_id, opts,
+                                       ack_source=acks, transfer_id=transfer_id)
+    finally:
+        transfer_table.unregister(transfer_id)
+
+def parse_chunk_request(message):
+    """
+    Tách yêu cầu "CHUNK <filename> <offset> <size> <part_id> [key=value ...]" hoặc
+    "RESEND <filename> <offset> <size> <part_id> <start-end,...> [key=value ...]".
+    Trả về (filename, offset, size, part_id, opts) hoặc None nếu yêu cầu sai;
+    các khoảng seq (đã tách) của RESEND nằm trong opts["ranges"].
+    """
+    request, opts = split_options(message)
+    command, _, rest = request.partition(" ")
+    fields = 5 if command == "RESEND" else 4
+    parts = rest.rsplit(maxsplit=fields - 1) if rest else []
+    if len(parts) < fields:
+        return None
+    if command == "RESEND":
+        # Kiểm tra ngay ở đây: ChunkTransfer đã giữ mmap và cwnd chung rồi thì không được lỗi nữa
+        opts["ranges"] = parse_ranges(parts.pop())
+        if opts["ranges"] is None:
+            return None
+    filename, offset_str, size_str, part_id_str = parts
+    try:
+        offset, size, part_id = int(offset_str), int(size_str), int(part_id_str)
+    except ValueError:
+        return None
+    # Slice memoryview với offset âm sẽ đếm từ cuối file, phải chặn ở đây;
+    # part_id nằm trong header 4 byte không dấu
+    if offset < 0 or size < 0 or not 0 <= part_id < 2 ** 32:
+        return None
+    try:
+        if offset > os.path.getsize(filename):
+            return None
+    except OSError:
+        pass  # File không tồn tại: để ChunkTransfer báo lỗi như trước
+    return filename, offset, size, part_id, opts
+
+class BoundedExecutor:
+    """
+    Số thread cố định lấy việc từ một hàng đợi, thay cho mỗi yêu cầu một thread mới:
+    một loạt CHUNK dồn dập không thể tạo hàng nghìn thread. submit() trả về False khi
+    số việc đang chạy và đang chờ đã tới workers + max_pending để vòng lặp chính trả lời
+    BUSY; với max_pending = 0 thì BUSY ngay khi mọi thread đều bận.
+    """
+    def __init__(self, workers, max_pending=0):
+        self.limit = workers + max_pending
+        self.lock = threading.Lock()
+        self.accepted = 0  # Số việc đã nhận mà chưa chạy xong
+        self.tasks = queue.Queue()
+        for _ in range(workers):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.accepted >= self.limit:
+                return False
+            self.accepted += 1
+        self.tasks.put((fn, args))
+        return True
+
+    def run(self):
+        while True:
+            fn, args = self.tasks.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"[SERVER] Error: {e}")
+            finally:
+                with self.lock:
+                    self.accepted -= 1
+
+def open_server_socket():
+    """Socket UDP nghe SERVER_PORT; nhiều process thì bật SO_REUSEPORT để cùng bind được"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if WORKER_PROCESSES > 1:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((SERVER_IP, SERVER_PORT))
+    return sock
+
+def attach_reuseport_filter(sock):
+    """
+    Gắn bộ lọc CBPF cho nhóm reuseport: gói điều khiển (byte đầu CTRL_MAGIC) đi tới
+    socket có chỉ số bằng byte cao của transfer_id, tức process đã cấp transfer đó.
+    Gói khác trả về chỉ số không hợp lệ nên kernel chọn theo hash địa chỉ như bình
+    thường, vì vậy CHUNK/RESEND từ cùng một socket client luôn về cùng một process.
+    """
+    program = [
+        (0x30, 0, 0, 0),           # A = byte 0 của payload UDP
+        (0x15, 0, 2, CTRL_MAGIC),  # A == CTRL_MAGIC ? tiếp : nhảy tới lệnh cuối
+        (0x30, 0, 0, 4),           # A = byte cao của transfer_id (CTRL_FORMAT "!BBHI")
+        (0x16, 0, 0, 0),           # return A
+        (0x06, 0, 0, 0xFFFFFFFF),  # return chỉ số không hợp lệ -> chọn theo hash
+    ]
+    code = ctypes.create_string_buffer(b"".join(struct.pack("HBBI", *insn) for insn in program))
+    fprog = struct.pack("HP", len(program), ctypes.addressof(code))  # struct sock_fprog
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, fprog)
+
+def run_workers(run):
+    """
+    Chạy WORKER_PROCESSES process, mỗi process một socket SERVER_PORT và một engine riêng
+    (run(sock)) nên băng thông tăng theo số core thay vì bị GIL giới hạn. Các socket được
+    bind ở process cha theo thứ tự trước khi fork để chỉ số trong nhóm reuseport trùng
+    với WORKER_INDEX; process cha giữ chúng mở cho tới khi các worker kết thúc.
+    """
+    global WORKER_INDEX
+    socks = [open_server_socket() for _ in range(WORKER_PROCESSES)]
+    try:
+        attach_reuseport_filter(socks[0])
+    except OSError as e:
+        print(f"[SERVER] Reuseport filter unavailable ({e}), ACKs are routed by address hash only")
+    pids = []
+    for index, sock in enumerate(socks):
+        pid = os.fork()
+        if pid == 0:
+            WORKER_INDEX = index
+            for other in socks:
+                if other is not sock:
+                    other.close()
+            try:
+                run(sock)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    print(f"[SERVER] Started {len(pids)} worker processes on port {SERVER_PORT}")
+
+    def stop(*_):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        stop()
+
+def main(sock_main=None):
+    if sock_main is None:
+        sock_main = open_server_socket()
+    print(f"[SERVER] Worker {WORKER_INDEX} listening on {SERVER_IP}:{SERVER_PORT}")
+    # Transfer giữ thread tới khi xong (client mất thì tới TRANSFER_IDLE_LIMIT) nên LIST,
+    # DOWNLOAD, PROBE được trả lời ngay trên vòng lặp chính và MANIFEST có pool riêng:
+    # chúng không bao giờ phải xếp hàng sau các transfer
+    executor = BoundedExecutor(WORKER_THREADS)
+    manifest_executor = BoundedExecutor(MANIFEST_THREADS, MAX_PENDING_MANIFESTS)
 
     while True:
         try:
             data, client_addr = sock_main.recvfrom(4096)
+            if data and data[0] == CTRL_MAGIC:
+                # Gói điều khiển (ACK) của một transfer ở chế độ mux, hoặc DOWNLOAD do worker khác chuyển
+                if data[1:2] == bytes([CTRL_FORWARD]):
+                    handle_forward(sock_main, data, client_addr)
+                else:
+                    transfer_table.dispatch(data, client_addr)
+                continue
             message = data.decode()
             print(f"[SERVER] Received '{message}' from {client_addr}")
-            if message == "LIST":
-                # Tạo thread riêng cho yêu cầu file list
-                t = threading.Thread(target=send_file_list, args=(sock_main, client_addr))
-                t.start()
-            elif message.startswith("DOWNLOAD"):
+            # CHUNK/RESEND và MANIFEST chạy trên thread của executor; hết chỗ thì trả lời BUSY
+            accepted = True
+            if message.startswith("LIST"):
+                _, opts = split_options(message)
+                send_file_list(sock_main, client_addr, opts)
+            elif message.startswith("MANIFEST"):
                 _, filename = message.split(maxsplit=1)
-                send_file_size(sock_main, client_addr, filename)
-            elif message.startswith("CHUNK"):
-                parts = message.split()
-                if len(parts) < 5:
+                # Lần đầu phải hash cả file nên không chạy trên vòng lặp chính
+                accepted = manifest_executor.submit(send_manifest, sock_main, client_addr, filename)
+            elif message.startswith("PROBE"):
+                _, size = message.split()
+                send_probe_reply(sock_main, client_addr, int(size))
+            elif message.startswith("DOWNLOAD"):
+                request, opts = split_options(message)
+                _, filename = request.split(maxsplit=1)
+                send_file_size(sock_main, client_addr, filename, opts)
+            elif message.startswith("CHUNK") or message.startswith("RESEND"):
+                chunk_request = parse_chunk_request(message)
+                if chunk_request is None:
                     sock_main.sendto(b"ERROR: Invalid CHUNK request", client_addr)
                     continue
-                _, filename, offset_str, size_str, part_id_str = parts
-                offset = int(offset_str)
-                size = int(size_str)
-                part_id = int(part_id_str)
-                # Tạo thread riêng cho mỗi chunk
-                t = threading.Thread(target=handle_chunk, args=(filename, offset, size, part_id, client_addr))
-                t.start()
+                if negotiate_options(chunk_request[4]).get("mux") == "1":
+                    accepted = executor.submit(handle_chunk_mux, sock_main, *chunk_request[:4],
+                                               client_addr, chunk_request[4])
+                else:
+                    accepted = executor.submit(handle_chunk, *chunk_request[:4], client_addr, chunk_request[4])
             # Có thể mở rộng xử lý các yêu cầu khác nếu cần.
+            if not accepted:
+                send_busy(sock_main, client_addr)
         except Exception as e:
             print(f"[SERVER] Error: {e}")
             continue
 
+class AsyncChunkSender(asyncio.DatagramProtocol):
+    """
+    Engine asyncio: endpoint UDP cổng ngẫu nhiên cho một part (giống socket phụ của
+    handle_chunk) nhưng chạy trên event loop, phát lại bằng timer thay vì socket timeout.
+    Ở chế độ mux, sender dùng chung transport của AsyncServerProtocol (owns_transport=False)
+    và nhận ACK qua transfer_table.
+    """
+    def __init__(self, transfer, owns_transport=True):
+        self.transfer = transfer
+        self.owns_transport = owns_transport
+        self.transport = None
+        self.timer = None
+        self.finished = False
+
+    def connection_made(self, transport):
+        print(f"[SERVER] Handling part {self.transfer.part_id} on socket {transport.get_extra_info('sockname')}")
+        self.start(transport)
+
+    def start(self, transport):
+        self.transport = transport
+        try:
+            self.pump()
+            self.schedule_timer()
+        except Exception as e:
+            self.fail(e)
+
+    def fail(self, e):
+        # Giống try/finally của send_chunk_part_sliding_window: báo lỗi cho client và trả mọi tài nguyên
+        error_msg = f"ERROR: {str(e)}"
+        print(f"[SERVER] Part {self.transfer.part_id}: {error_msg}")
+        self.transport.sendto(error_msg.encode(), self.transfer.client_addr)
+        self.transfer.gave_up = True
+        self.finish()
+
+    def send(self, packets):
+        for header, payload in packets:
+            # transport.sendto chỉ nhận một buffer nên phải ghép header và payload
+            self.transport.sendto(header + payload, self.transfer.client_addr)
+
+    def pump(self):
+        self.send(self.transfer.fill_window())
+        if self.transfer.done:
+            self.finish()
+
+    def datagram_received(self, data, addr):
+        if self.finished or addr[0] != self.transfer.client_addr[0]:
+            return
+        if self.transfer.on_ack(data):
+            self.pump()
+        # RTO có thể vừa giảm sau mẫu RTT mới, hoặc transfer đang chờ token/cwnd:
+        # hẹn giờ lại nếu hạn mới sớm hơn
+        deadline = time.monotonic() + self.transfer.time_to_deadline()
+        if self.timer is not None and deadline < self.timer.when():
+            self.timer.cancel()
+            self.schedule_timer()
+
+    def schedule_timer(self):
+        # Hẹn giờ tới lúc segment cũ nhất chưa có ACK quá RTO (event loop dùng cùng đồng hồ monotonic)
+        if self.finished:
+            return
+        loop = asyncio.get_running_loop()
+        self.timer = loop.call_later(self.transfer.time_to_deadline(), self.on_timer)
+
+    def on_timer(self):
+        try:
+            self.send(self.transfer.on_timeout())
+            # cwnd chung của client có thể vừa được part khác giải phóng
+            self.pump()
+            self.schedule_timer()
+        except Exception as e:
+            self.fail(e)
+
+    def error_received(self, exc):
+        print(f"[SERVER] Part {self.transfer.part_id}: socket error {exc}")
+
+    def connection_lost(self, exc):
+        self.finish()
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        if self.timer is not None:
+            self.timer.cancel()
+        self.transfer.close()
+        if self.owns_transport:
+            self.transport.close()
+        else:
+            transfer_table.unregister(self.transfer.transfer_id)
+        if not self.transfer.gave_up:
+            print(f"[SERVER] Completed sending part {self.transfer.part_id}")
+
+class AsyncServerProtocol(asyncio.DatagramProtocol):
+    """Engine asyncio: xử lý LIST/MANIFEST/DOWNLOAD/CHUNK trên cổng SERVER_PORT bằng một event loop"""
+    def __init__(self, sock):
+        self.sock = sock  # Socket gốc của transport, để gửi PROBE với cờ DF
+        self.transport = None
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def datagram_received(self, data, client_addr):
+        if data and data[0] == CTRL_MAGIC:
+            if data[1:2] == bytes([CTRL_FORWARD]):
+                handle_forward(self.transport, data, client_addr)
+            else:
+                transfer_table.dispatch(data, client_addr)
+            return
+        try:
+            message = data.decode()
+            print(f"[SERVER] Received '{message}' from {client_addr}")
+            if message.startswith("LIST"):
+                _, opts = split_options(message)
+                send_file_list(self.transport, client_addr, opts)
+            elif message.startswith("MANIFEST"):
+                _, filename = message.split(maxsplit=1)
+                self.spawn(self.handle_manifest(filename, client_addr))
+            elif message.startswith("PROBE"):
+                _, size = message.split()
+                send_probe_reply(self.sock, client_addr, int(size))
+            elif message.startswith("DOWNLOAD"):
+                request, opts = split_options(message)
+                _, filename = request.split(maxsplit=1)
+                send_file_size(self.transport, client_addr, filename, opts)
+            elif message.startswith("CHUNK") or message.startswith("RESEND"):
+                chunk_request = parse_chunk_request(message)
+                if chunk_request is None:
+                    self.transport.sendto(b"ERROR: Invalid CHUNK request", client_addr)
+                    return
+                if len(active_parts) >= MAX_ACTIVE_TRANSFERS:
+                    # Không tốn thread nhưng vẫn giới hạn số part để bộ nhớ và băng thông không bị chia quá mỏng
+                    send_busy(self.transport, client_addr)
+                    return
+                self.spawn(self.handle_chunk(*chunk_request[:4], client_addr, chunk_request[4]))
+        except Exception as e:
+            print(f"[SERVER] Error: {e}")
+
+    async def handle_manifest(self, filename, client_addr):
+        if not file_catalog.contains(filename) or not os.path.exists(filename):
+            self.transport.sendto(b"ERROR: File not found.", client_addr)
+            return
+        try:
+            # Hash file là việc chặn nên chạy trong thread pool mặc định của event loop
+            manifest = await asyncio.get_running_loop().run_in_executor(None, load_manifest, filename)
+        except Exception as e:
+            self.transport.sendto(f"ERROR: {str(e)}".encode(), client_addr)
+            return
+        print(f"[SERVER] Sending manifest for '{filename}' to {client_addr}")
+        send_paged(self.transport, client_addr, json.dumps(manifest).encode())
+
+    async def handle_chunk(self, filename, offset, size, part_id, client_addr, opts):
+        mux = negotiate_options(opts).get("mux") == "1"
+        transfer_id = transfer_table.allocate() if mux else 0
+        try:
+            transfer = ChunkTransfer(filename, offset, size, part_id, client_addr, opts, transfer_id)
+        except Exception as e:
+            error_msg = f"ERROR: {str(e)}"
+            print(f"[SERVER] {error_msg}")
+            self.transport.sendto(error_msg.encode(), client_addr)
+            return
+        if mux:
+            # Chế độ mux: gửi trên chính socket SERVER_PORT, ACK đến qua transfer_table
+            sender = AsyncChunkSender(transfer, owns_transport=False)
+            transfer_table.register(transfer_id, lambda packet: sender.datagram_received(packet, client_addr),
+                                    client_addr[0])
+            print(f"[SERVER] Handling part {part_id} as transfer {transfer_id} on main socket")
+            sender.start(self.transport)
+            return
+        try:
+            await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: AsyncChunkSender(transfer), local_addr=("0.0.0.0", 0))
+        except Exception:
+            transfer.close()
+            raise
+
+async def main_async(sock=None):
+    loop = asyncio.get_running_loop()
+    sock = sock or open_server_socket()
+    transport, _ = await loop.create_datagram_endpoint(lambda: AsyncServerProtocol(sock), sock=sock)
+    print(f"[SERVER] Worker {WORKER_INDEX} listening on {SERVER_IP}:{SERVER_PORT} (asyncio engine)")
+    try:
+        await asyncio.Event().wait()  # Chạy cho tới khi bị dừng (Ctrl+C)
+    finally:
+        transport.close()
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="UDP file server")
+    parser.add_argument("--verbose", action="store_true", help="in log cho từng segment")
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default="thread",
+                        help="thread: pool WORKER_THREADS thread gửi các CHUNK; asyncio: một event loop cho mọi transfer")
+    parser.add_argument("--cc", choices=sorted(CONGESTION_CONTROLLERS), default=CONGESTION_CONTROL,
+                        help="thuật toán chống nghẽn dùng chung cho các part của một client")
+    parser.add_argument("--rate", type=float, default=PACING_RATE,
+                        help="giới hạn tổng tốc độ gửi (byte/giây), 0 = không giới hạn")
+    parser.add_argument("--part-rate", type=float, default=PART_PACING_RATE,
+                        help="giới hạn tốc độ gửi của mỗi part (byte/giây), 0 = không giới hạn")
+    parser.add_argument("--compress", choices=("none",) + tuple(sorted(COMPRESSORS)), default=COMPRESSION,
+                        help="nén segment cho client hỗ trợ (file nén không được sẽ tự động gửi nguyên bản)")
+    parser.add_argument("--compress-level", type=int, default=COMPRESSION_LEVEL, help="mức nén (1-9)")
+    parser.add_argument("--multicast", action="store_true",
+                        help="phát file lớn qua multicast cho các client cùng tải, client NACK phần thiếu")
+    parser.add_argument("--mcast-if", default=MULTICAST_INTERFACE,
+                        help="địa chỉ card mạng phát multicast (127.0.0.1 để thử trên một máy)")
+    parser.add_argument("--mcast-rate", type=float, default=MULTICAST_RATE, help="tốc độ phát multicast (byte/giây)")
+    parser.add_argument("--scan-dir", metavar="DIR",
+                        help="chia sẻ mọi file trong DIR (theo dõi thay đổi) thay vì đọc danh sách từ files.txt")
+    parser.add_argument("--workers", type=int, default=WORKER_PROCESSES,
+                        help="số process cùng nghe SERVER_PORT bằng SO_REUSEPORT (tối đa 256)")
+    args = parser.parse_args()
+    if args.workers > 1 and not HAS_REUSEPORT:
+        parser.error("--workers cần SO_REUSEPORT và fork (Linux/BSD)")
+    WORKER_PROCESSES = max(1, min(args.workers, 256))
+    COMPRESSION = args.compress
+    if args.scan_dir:
+        # Tên file trong LIST/DOWNLOAD/CHUNK là đường dẫn tương đối so với thư mục chia sẻ
+        os.chdir(args.scan_dir)
+        CATALOG_SCAN_DIR = True
+    MULTICAST_ENABLED = args.multicast
+    MULTICAST_INTERFACE = args.mcast_if
+    MULTICAST_RATE = args.mcast_rate
+    COMPRESSION_LEVEL = args.compress_level
+    CONGESTION_CONTROL = args.cc
+    VERBOSE = args.verbose
+    PART_PACING_RATE = args.part_rate
+    # Mỗi process có bộ giới hạn riêng nên chia đều tổng tốc độ
+    global_pacer.set_rate(args.rate / WORKER_PROCESSES)
+    if args.engine == "asyncio":
+        run = lambda sock: asyncio.run(main_async(sock))
+    else:
+        run = main
+    if WORKER_PROCESSES > 1:
+        run_workers(run)
+    else:
+        run(None)